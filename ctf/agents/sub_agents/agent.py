@@ -11,6 +11,8 @@ from ctf.agents.tools import (
     rag_tool_func_tool,
     leaderboard_stats_tool,
     help_search_tool,
+    preload_level_vectors,
+    start_rag_stats_logger,
 )
 from ctf.agents.sub_agents.level_0_agent import Level0Agent
 from ctf.agents.sub_agents.level_1_agent import Level1Agent
@@ -113,3 +115,6 @@ Do not block the user if they submit the correct answer
 
 
 root_agent = CTFSubAgentsRootAgent()  # noqa: F841
+
+preload_level_vectors()
+start_rag_stats_logger()
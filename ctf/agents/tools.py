@@ -1,25 +1,27 @@
 import asyncio
-import ipaddress
 import json
 import logging
 import os
 import re
-import socket
 import sqlite3
 import subprocess
 import sys
+import threading
 from pathlib import Path
-from urllib.parse import urlparse
 
-import lancedb
-import requests
+import httpx
 from google.adk.tools import FunctionTool
 from google.adk.tools.tool_context import ToolContext
 from google.adk.tools.transfer_to_agent_tool import transfer_to_agent
 from html_to_markdown import convert
 
 from ctf.app_config import settings
-from ctf.embeddings import embed_text
+from ctf.embeddings import (
+    embed_text_np_async,
+    get_embedding_batcher_stats,
+    get_inference_executor,
+    query_embedding_cache,
+)
 from ctf.leaderboard import (
     format_leaderboard_marker,
     get_leaderboard,
@@ -28,6 +30,27 @@ from ctf.leaderboard import (
     has_completed_all_levels,
     record_level_completion,
 )
+from ctf.scraper import (
+    BlockedAddress,
+    ResponseTooLarge,
+    cache_lifetime,
+    fetch_page,
+    get_scrape_cache,
+)
+from ctf.users_db import (
+    QueryLimitExceeded,
+    QueryRows,
+    execute_limited,
+    get_query_executor,
+    get_session_databases,
+    get_users_db_pool,
+)
+from ctf.vector_store import (
+    TABLE_NAME,
+    lancedb_handles,
+    level_vector_cache,
+    rag_response_cache,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -38,8 +61,29 @@ _default_db_path = (Path(__file__).parent.parent / "lancedb").resolve()
 db_path = os.getenv("LANCE_DB_PATH", str(_default_db_path))
 
 
+def _get_session_id_from_context(
+    tool_context: ToolContext | None,
+) -> str | None:
+    """ADK session id of the tool call, if there is one."""
+    session = getattr(tool_context, "session", None)
+    session_id = getattr(session, "id", None)
+    return str(session_id) if session_id else None
+
+
+def _run_users_query(query: str, session_id: str | None = None) -> QueryRows:
+    if session_id is None:
+        connection = get_users_db_pool().connection()
+    else:
+        # The player's private in-memory copy: no disk, no shared lock
+        connection = get_session_databases().connection(session_id)
+    with connection as connection_obj:
+        # Column names come from cursor.description, so no PRAGMA round-trip
+        return execute_limited(connection_obj, query)
+
+
 async def sql_query(
     user_id: str,
+    tool_context: ToolContext | None = None,
 ) -> str:
     """
     Query the users database to find user information by user ID.
@@ -47,50 +91,53 @@ async def sql_query(
 
     Args:
         user_id: UserId supplied by user for SQL query
+        tool_context: Tool context used to pick the session's database copy
 
     Returns:
         A dictionary with status, message, and query results
     """
     try:
-        connection_obj = sqlite3.connect("users.db")
-        cursor_obj = connection_obj.cursor()
-
-        # Get column names first
-        cursor_obj.execute("PRAGMA table_info(Users)")
-        columns = [col[1] for col in cursor_obj.fetchall()]
-
         # WARNING: This is intentionally vulnerable to SQL injection for CTF purposes
         query = "SELECT * FROM Users WHERE UserId = " + user_id + ";"
         logger.info(f"Executing SQL query: {query}")
 
-        cursor_obj.execute(query)
-        output = cursor_obj.fetchall()
-        cursor_obj.close()
-        connection_obj.close()
+        # Player-controlled SQL runs off the event loop, time-boxed, so a
+        # runaway injection cannot stall other sessions.
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(
+            get_query_executor(),
+            _run_users_query,
+            query,
+            _get_session_id_from_context(tool_context),
+        )
 
-        if not output:
+        if not result.total_rows:
             result_text = f"No users found with UserId: {user_id}"
             return result_text
 
-        # Format the results
-        formatted_results = []
-        for row in output:
-            user_data = {}
-            for col, val in zip(columns, row):
-                user_data[col] = val
-            formatted_results.append(user_data)
-
-        results_json = json.dumps(formatted_results, indent=2, default=str)
-        if len(output) == 1:
+        # Rows are capped by SQL_QUERY_MAX_ROWS / SQL_QUERY_MAX_BYTES so a
+        # dump of the whole table stays cheap in memory and model tokens
+        results_json = result.to_json()
+        if result.truncated_rows:
+            at_least = "" if result.exact_total else "at least "
+            results_json += (
+                f"\n... {at_least}{result.truncated_rows} more rows truncated"
+            )
+        if result.total_rows == 1:
             result_text = f"Found user with UserId: {user_id}\n{results_json}"
             return result_text
         else:
+            total = f"{result.total_rows}{'' if result.exact_total else '+'}"
             result_text = (
-                f"Found {len(output)} user(s) with UserId: {user_id}\n"
+                f"Found {total} user(s) with UserId: {user_id}\n"
                 f"{results_json}"
             )
             return result_text
 
+    except QueryLimitExceeded as e:
+        logger.warning(f"sql_query interrupted: {e}")
+        result_text = f"Error executing SQL query: {e}"
+        return result_text
     except sqlite3.Error as e:
         error_msg = f"Database error: {str(e)}"
         logger.error(error_msg)
@@ -342,6 +389,130 @@ async def submit_answer_func(
         return error_msg
 
 
+RAG_RESULT_COLUMNS = ["text", "_distance"]
+RAG_FTS_RESULT_COLUMNS = ["text", "_score"]
+
+# One alternative per prepare_flags document template, in priority order.
+# finditer scans each document once, left to right, collecting every template
+# occurrence; the highest-priority one wins, wherever it appears. A document
+# matching no template is used whole if it is a single line.
+_PASSWORD_EXTRACTION_RE = re.compile(
+    r"The Password is (?P<password_is>.+)"
+    r"|The Secret is (?P<secret_is>.+)"
+    r"|that (?P<that_secret>.+) is the secret"
+    r"|that (?P<that_password>.+) is the password",
+    re.IGNORECASE,
+)
+_TEMPLATE_PRIORITY = {
+    name: priority
+    for priority, name in enumerate(_PASSWORD_EXTRACTION_RE.groupindex)
+}
+_BARE_DOCUMENT_RE = re.compile(r".+$")
+
+
+def extract_passwords(documents: list[str]) -> list[str]:
+    """Extract one candidate password per document, de-duplicated in order."""
+    extracted: dict[str, None] = {}
+    for doc in documents:
+        match = min(
+            _PASSWORD_EXTRACTION_RE.finditer(doc),
+            key=lambda m: _TEMPLATE_PRIORITY[m.lastgroup],
+            default=None,
+        ) or _BARE_DOCUMENT_RE.match(doc)
+        if match is None:
+            continue
+        candidate = match.group(match.lastgroup or 0).strip().rstrip(".,!?;:")
+        if candidate:
+            extracted[candidate] = None
+    return list(extracted)
+
+
+def _open_levels_table():
+    return lancedb_handles.open_table(db_path, TABLE_NAME)
+
+
+async def _open_levels_table_async():
+    return await lancedb_handles.open_table_async(db_path, TABLE_NAME)
+
+
+async def _search_levels_table(
+    table, query_vector, level: int
+) -> tuple[list[str], list[float]]:
+    """LanceDB fallback for corpora too large for the in-memory index."""
+    # Project just the two columns we return and read them straight from
+    # Arrow; building a pandas DataFrame per query was pure overhead. The
+    # async query API always prefilters on the where clause.
+    query = (
+        table.vector_search(query_vector)
+        .where(f"level = {level}")
+        .select(RAG_RESULT_COLUMNS)
+        .limit(5)
+        .nprobes(settings.RAG_NPROBES)
+    )
+    if settings.RAG_REFINE_FACTOR > 0:
+        query = query.refine_factor(settings.RAG_REFINE_FACTOR)
+    return _documents_from_arrow(await query.to_arrow())
+
+
+async def _fts_search_levels_table(
+    table, question: str, level: int
+) -> tuple[list[str], list[float]]:
+    """BM25 search over the ``text`` FTS index built by prepare_flags."""
+    query = (
+        table.query()
+        .nearest_to_text(question)
+        .where(f"level = {level}")
+        .select(RAG_FTS_RESULT_COLUMNS)
+        .limit(5)
+    )
+    return _documents_from_arrow(await query.to_arrow(), "_score")
+
+
+async def _full_text_search(
+    table, question: str, level: int, fallback: bool
+) -> tuple[list[str], list[float]] | None:
+    """
+    Run the FTS lookup. With ``fallback`` (hybrid mode) return None instead
+    of raising, or when fewer than RAG_FTS_MIN_HITS documents match, so the
+    caller embeds the question and runs a vector search instead. Hits are
+    counted rather than compared to a BM25 cutoff: raw BM25 scores shift
+    with the corpus (e.g. the decoy corpus), the number of matches does not.
+    """
+    try:
+        doc_list, scores = await _fts_search_levels_table(
+            table, question, level
+        )
+    except Exception as e:
+        if not fallback:
+            raise
+        logger.warning(f"Full-text search failed, using vector search: {e}")
+        return None
+    if fallback and len(doc_list) < max(1, settings.RAG_FTS_MIN_HITS):
+        return None
+    return doc_list, scores
+
+
+def _documents_from_arrow(
+    results, score_column: str = "_distance"
+) -> tuple[list[str], list[float]]:
+    names = results.schema.names
+    doc_list = results.column("text").to_pylist() if "text" in names else []
+    score_list = (
+        results.column(score_column).to_pylist()
+        if score_column in names
+        else []
+    )
+    return doc_list, score_list
+
+
+def preload_level_vectors() -> None:
+    """Load the in-memory RAG index at startup rather than on first query."""
+    try:
+        level_vector_cache.get(_open_levels_table)
+    except Exception as e:
+        logger.warning(f"Could not preload {TABLE_NAME} vectors: {e}")
+
+
 async def password_search_func(
     question: str,
     level: int,
@@ -358,13 +529,19 @@ async def password_search_func(
     Returns:
         A dictionary with status, search results, passwords found, and documents
     """
-    db = lancedb.connect(db_path)
-    table_name = "ctf_levels"
-
+    mode = settings.RAG_SEARCH_MODE
     try:
-        table = db.open_table(table_name)
+        index = await level_vector_cache.get_async(_open_levels_table_async)
+        if index is not None and mode == "vector":
+            table = None
+            version = index.version
+        else:
+            # FTS reads the live table, which can be ahead of the in-memory
+            # index, so the response is keyed on the table's own version
+            table = await _open_levels_table_async()
+            version = await table.version()
     except Exception as e:
-        logger.error(f"Error opening table {table_name}: {e}")
+        logger.error(f"Error opening table {TABLE_NAME}: {e}")
         error_response = {
             "status": "error",
             "message": f"No data found for level {level}. Database may need to be initialized.",
@@ -375,15 +552,39 @@ async def password_search_func(
         }
         return error_response
 
-    query_vector = embed_text(question)
+    cached = rag_response_cache.get(level, question, version)
+    if cached is not None:
+        logger.info(f"password_search_func cache hit for level {level}")
+        return cached
 
+    served_version = version
     try:
-        results = (
-            table.search(query_vector)
-            .where(f"level = {level}")
-            .limit(5)
-            .to_pandas()
-        )
+        fts_hits = None
+        if mode in ("fts", "hybrid"):
+            fts_hits = await _full_text_search(
+                table, question, level, fallback=mode == "hybrid"
+            )
+        # BM25 and 1 - L2 distance are on unrelated scales, so each mode
+        # reports its scores under its own key
+        if fts_hits is not None:
+            search_mode = "fts"
+            doc_list, fts_scores = fts_hits
+            scores_key = "bm25_scores"
+            scores = [round(score, 3) for score in fts_scores]
+        else:
+            search_mode = "vector"
+            query_vector = await embed_text_np_async(
+                question, normalize=settings.EMBEDDING_NORMALIZE
+            )
+            if index is not None:
+                doc_list, distance_list = index.search(level, query_vector, 5)
+                served_version = index.version
+            else:
+                doc_list, distance_list = await _search_levels_table(
+                    table, query_vector, level
+                )
+            scores_key = "relevance_scores"
+            scores = [round(1 - dist, 3) for dist in distance_list]
     except Exception as e:
         logger.error(f"Error searching table: {e}")
         error_response = {
@@ -396,47 +597,18 @@ async def password_search_func(
         }
         return error_response
 
-    if results.empty:
-        doc_list = []
-        distance_list = []
-    else:
-        doc_list = results["text"].tolist() if "text" in results.columns else []
-        distance_list = (
-            results["_distance"].tolist()
-            if "_distance" in results.columns
-            else []
-        )
-
-    extracted_passwords = []
-    password_patterns = [
-        r"The Password is (.+)",
-        r"The Secret is (.+)",
-        r"that (.+) is the secret",
-        r"that (.+) is the password",
-        r"^(.+)$",
-    ]
-
-    for doc in doc_list:
-        for pattern in password_patterns:
-            match = re.search(pattern, doc, re.IGNORECASE)
-            if match:
-                extracted = match.group(1).strip()
-                extracted = extracted.rstrip(".,!?;:")
-                if extracted and extracted not in extracted_passwords:
-                    extracted_passwords.append(extracted)
-                    break
+    extracted_passwords = extract_passwords(doc_list)
 
     response = {
         "documents": doc_list,
-        "extracted_passwords": list(set(extracted_passwords)),
+        "extracted_passwords": extracted_passwords,
         "level": level,
         "num_results": len(doc_list),
+        "search_mode": search_mode,
     }
 
-    if distance_list:
-        response["relevance_scores"] = [
-            round(1 - dist, 3) for dist in distance_list
-        ]
+    if scores:
+        response[scores_key] = scores
 
     logger.info(
         f"password_search_func results for level {level}: {len(doc_list)} documents, "
@@ -457,7 +629,75 @@ async def password_search_func(
             "for this level."
         )
 
-    return json.dumps(response, indent=2)
+    serialized = json.dumps(response, indent=2)
+    # A hybrid fallback answered from an index older than the table must not
+    # be cached under the table's newer version
+    if served_version == version:
+        rag_response_cache.put(level, question, version, serialized)
+    return serialized
+
+
+def get_rag_cache_stats() -> dict:
+    """Counters for the RAG caches, for dashboards and debugging."""
+    return {
+        "responses": rag_response_cache.stats(),
+        "query_embeddings": query_embedding_cache.stats(),
+    }
+
+
+def get_rag_stats() -> dict:
+    """
+    The cache counters plus the embedding inference queue and the query
+    embedding batchers (one per event loop).
+    """
+    return {
+        **get_rag_cache_stats(),
+        "inference_executor": get_inference_executor().stats(),
+        "embedding_batchers": get_embedding_batcher_stats(),
+    }
+
+
+_stats_logger: threading.Thread | None = None
+_stats_logger_stop = threading.Event()
+_stats_logger_lock = threading.Lock()
+
+
+def _log_rag_stats(interval: float) -> None:
+    while not _stats_logger_stop.wait(interval):
+        logger.info(f"RAG stats: {json.dumps(get_rag_stats())}")
+
+
+def start_rag_stats_logger() -> None:
+    """
+    Log the RAG counters every RAG_STATS_LOG_INTERVAL_SECONDS from a daemon
+    thread, so hit rates show up in the ADK server's logs. Does nothing if
+    the interval is 0 or the logger is already running.
+    """
+    global _stats_logger
+    interval = settings.RAG_STATS_LOG_INTERVAL_SECONDS
+    if interval <= 0:
+        return
+    with _stats_logger_lock:
+        if _stats_logger is not None and _stats_logger.is_alive():
+            return
+        _stats_logger_stop.clear()
+        _stats_logger = threading.Thread(
+            target=_log_rag_stats,
+            args=(interval,),
+            name="rag-stats",
+            daemon=True,
+        )
+        _stats_logger.start()
+
+
+def stop_rag_stats_logger() -> None:
+    global _stats_logger
+    with _stats_logger_lock:
+        if _stats_logger is None:
+            return
+        _stats_logger_stop.set()
+        _stats_logger.join()
+        _stats_logger = None
 
 
 def _get_username_from_context(tool_context: ToolContext | None) -> str | None:
@@ -559,32 +799,25 @@ async def get_leaderboard_stats(limit: int = 25) -> str:
 MAX_SCRAPE_BYTES = 2_000_000
 
 
-def _web_scrape_safety_error(url: str) -> str | None:
-    """Return an error message if url is unsafe to scrape, else None.
-
-    Blocks non-http(s) schemes and hosts resolving to loopback/link-local/
-    private addresses (including the 169.254.169.254 cloud metadata
-    endpoint) to keep this tool scoped to fetching public web pages rather
-    than acting as an SSRF pivot into internal infrastructure.
-    """
-    parsed = urlparse(url)
-    if parsed.scheme not in ("http", "https"):
-        return f"Blocked: unsupported URL scheme '{parsed.scheme}'"
+def _html_to_markdown(html: str) -> str:
+    # html-to-markdown 3.x returns a ConversionResult rather than a str
+    result = convert(html)
+    return getattr(result, "content", result)
 
-    hostname = parsed.hostname
-    if not hostname:
-        return "Blocked: URL has no hostname"
 
+async def _scrape_cache_call(cache, method: str, *args):
+    """
+    Run a ScrapeCache method off the event loop. A broken or locked cache
+    file only costs the cache: errors are logged and None is returned, so
+    the page is fetched from the network as if it were not cached.
+    """
+    if cache is None:
+        return None
     try:
-        resolved_ip = socket.gethostbyname(hostname)
-        ip_obj = ipaddress.ip_address(resolved_ip)
-    except (socket.gaierror, ValueError) as e:
-        return f"Blocked: could not resolve host '{hostname}': {e}"
-
-    if ip_obj.is_loopback or ip_obj.is_link_local or ip_obj.is_private:
-        return f"Blocked: URL resolves to a disallowed address ({resolved_ip})"
-
-    return None
+        return await asyncio.to_thread(getattr(cache, method), *args)
+    except sqlite3.Error as e:
+        logger.warning(f"Skipping web_scrape cache {method} ({e})")
+        return None
 
 
 async def web_scrape(url: str) -> str:
@@ -597,35 +830,55 @@ async def web_scrape(url: str) -> str:
     Returns:
         A dictionary with status and the markdown representation of the web page content
     """
-    safety_error = _web_scrape_safety_error(url)
-    if safety_error:
-        logger.warning(f"Blocked web_scrape request for {url}: {safety_error}")
-        return safety_error
-
     try:
-        response = requests.get(url, timeout=10, stream=True)
-        response.raise_for_status()
-
-        content_length = response.headers.get("Content-Length")
-        if content_length and int(content_length) > MAX_SCRAPE_BYTES:
-            return f"Error: response too large ({content_length} bytes)"
-
-        body = bytearray()
-        for chunk in response.iter_content(chunk_size=8192):
-            body.extend(chunk)
-            if len(body) > MAX_SCRAPE_BYTES:
-                body = body[:MAX_SCRAPE_BYTES]
-                break
-
-        encoding = response.encoding or response.apparent_encoding or "utf-8"
-        text = bytes(body).decode(encoding, errors="replace")
-
-        markdown_content = convert(text)
+        # Fresh cached pages skip the network and the conversion; stale ones
+        # are revalidated with the stored ETag / Last-Modified
+        cache = get_scrape_cache()
+        cached = await _scrape_cache_call(cache, "get", url)
+        headers = {}
+        if cached is not None:
+            markdown_content, etag, last_modified, fresh = cached
+            if fresh:
+                return markdown_content
+            if etag:
+                headers["If-None-Match"] = etag
+            if last_modified:
+                headers["If-Modified-Since"] = last_modified
+
+        # Only public http(s) hosts are fetched, so this tool is not an SSRF
+        # pivot into loopback/private networks or the 169.254.169.254 cloud
+        # metadata endpoint (see ctf.scraper)
+        response, text = await fetch_page(url, MAX_SCRAPE_BYTES, headers)
+        lifetime = (
+            cache_lifetime(response.headers, cache.ttl_seconds)
+            if cache
+            else None
+        )
+        if response.status_code == 304 and cached is not None:
+            await _scrape_cache_call(cache, "renew", url, lifetime or 0.0)
+            return markdown_content
+
+        markdown_content = _html_to_markdown(text)
+        if lifetime is not None:
+            await _scrape_cache_call(
+                cache,
+                "put",
+                url,
+                markdown_content,
+                response.headers.get("ETag"),
+                response.headers.get("Last-Modified"),
+                lifetime,
+            )
 
         logger.info(f"Successfully scraped and converted {url} to markdown")
         return markdown_content
 
-    except requests.RequestException as e:
+    except BlockedAddress as e:
+        logger.warning(f"Blocked web_scrape request for {url}: {e}")
+        return f"Blocked: {e}"
+    except ResponseTooLarge as e:
+        return f"Error: {e}"
+    except httpx.HTTPError as e:
         error_msg = f"Error fetching URL {url}: {str(e)}"
         logger.error(error_msg)
         return error_msg
@@ -76,6 +76,185 @@ class Settings(BaseSettings):
         "LEADERBOARD_DB_PATH",
         str(Path(__file__).resolve().parent / "leaderboard.db"),
     )
+    # Level 5 SQLite database, written by prepare_flags and read by sql_query
+    # through a per-process pool of read-only connections. Set
+    # USERS_DB_IMMUTABLE only if nothing rewrites the file while serving.
+    USERS_DB_PATH: str = os.getenv("USERS_DB_PATH", "users.db")
+    USERS_DB_POOL_SIZE: int = int(os.getenv("USERS_DB_POOL_SIZE", 8))
+    USERS_DB_IMMUTABLE: bool = os.getenv("USERS_DB_IMMUTABLE", "").lower() in (
+        "1",
+        "true",
+        "yes",
+    )
+    # Each ADK session queries its own in-memory copy of users.db, made with
+    # the SQLite backup API on first use. At most USERS_DB_SESSION_MAX copies
+    # are kept (least recently used evicted first), and a copy idle for
+    # USERS_DB_SESSION_TTL_SECONDS is dropped.
+    USERS_DB_SESSION_MAX: int = int(os.getenv("USERS_DB_SESSION_MAX", 256))
+    USERS_DB_SESSION_TTL_SECONDS: float = float(
+        os.getenv("USERS_DB_SESSION_TTL_SECONDS", 1800)
+    )
+    # sql_query runs on SQL_QUERY_WORKERS dedicated threads and interrupts a
+    # query after SQL_QUERY_TIMEOUT_SECONDS or SQL_QUERY_MAX_VM_STEPS SQLite
+    # VM instructions (0 disables a limit), checked every
+    # SQL_QUERY_PROGRESS_INTERVAL instructions.
+    SQL_QUERY_WORKERS: int = int(os.getenv("SQL_QUERY_WORKERS", 4))
+    SQL_QUERY_TIMEOUT_SECONDS: float = float(
+        os.getenv("SQL_QUERY_TIMEOUT_SECONDS", 2)
+    )
+    SQL_QUERY_MAX_VM_STEPS: int = int(
+        os.getenv("SQL_QUERY_MAX_VM_STEPS", 50_000_000)
+    )
+    SQL_QUERY_PROGRESS_INTERVAL: int = int(
+        os.getenv("SQL_QUERY_PROGRESS_INTERVAL", 1000)
+    )
+    # sql_query streams rows with fetchmany(SQL_QUERY_FETCH_SIZE) and returns
+    # at most SQL_QUERY_MAX_ROWS rows / SQL_QUERY_MAX_BYTES of compact JSON,
+    # followed by a count of the rows left out. Counting stops after
+    # SQL_QUERY_MAX_COUNTED_ROWS rows and is then reported as "at least".
+    SQL_QUERY_FETCH_SIZE: int = int(os.getenv("SQL_QUERY_FETCH_SIZE", 100))
+    SQL_QUERY_MAX_ROWS: int = int(os.getenv("SQL_QUERY_MAX_ROWS", 50))
+    SQL_QUERY_MAX_BYTES: int = int(os.getenv("SQL_QUERY_MAX_BYTES", 16_384))
+    SQL_QUERY_MAX_COUNTED_ROWS: int = int(
+        os.getenv("SQL_QUERY_MAX_COUNTED_ROWS", 1_000)
+    )
+    # web_scrape (Level 9) shares one httpx client per event loop, keeping up
+    # to WEB_SCRAPE_MAX_KEEPALIVE idle connections open between calls.
+    WEB_SCRAPE_TIMEOUT_SECONDS: float = float(
+        os.getenv("WEB_SCRAPE_TIMEOUT_SECONDS", 10)
+    )
+    WEB_SCRAPE_MAX_CONNECTIONS: int = int(
+        os.getenv("WEB_SCRAPE_MAX_CONNECTIONS", 20)
+    )
+    WEB_SCRAPE_MAX_KEEPALIVE: int = int(
+        os.getenv("WEB_SCRAPE_MAX_KEEPALIVE", 10)
+    )
+    WEB_SCRAPE_MAX_REDIRECTS: int = int(
+        os.getenv("WEB_SCRAPE_MAX_REDIRECTS", 5)
+    )
+    # On-disk cache of scraped pages as markdown; empty disables it. Pages
+    # older than WEB_SCRAPE_CACHE_TTL_SECONDS are revalidated with a
+    # conditional GET, and least recently used pages are evicted past
+    # WEB_SCRAPE_CACHE_MAX_BYTES.
+    WEB_SCRAPE_CACHE_PATH: str = str(
+        os.getenv("WEB_SCRAPE_CACHE_PATH", "./web_scrape_cache.db")
+    )
+    WEB_SCRAPE_CACHE_TTL_SECONDS: float = float(
+        os.getenv("WEB_SCRAPE_CACHE_TTL_SECONDS", 300)
+    )
+    WEB_SCRAPE_CACHE_MAX_BYTES: int = int(
+        os.getenv("WEB_SCRAPE_CACHE_MAX_BYTES", 64 * 2**20)
+    )
+    # Query-embedding micro-batching: concurrent embed requests arriving
+    # within the window are run through the model as one padded batch.
+    EMBEDDING_BATCH_MAX_SIZE: int = int(
+        os.getenv("EMBEDDING_BATCH_MAX_SIZE", 32)
+    )
+    EMBEDDING_BATCH_WINDOW_MS: float = float(
+        os.getenv("EMBEDDING_BATCH_WINDOW_MS", 5)
+    )
+    # Upper bound on texts per forward pass when embedding in bulk; inputs
+    # are length-bucketed so each pass pads only to its own longest text.
+    EMBEDDING_MAX_BATCH_SIZE: int = int(
+        os.getenv("EMBEDDING_MAX_BATCH_SIZE", 64)
+    )
+    # Embedding inference runs on its own thread pool, off the event loop.
+    # Size workers x TORCH_NUM_THREADS to the host's core count; 0 leaves
+    # torch's own thread defaults in place. The RAG stats log line reports
+    # its queue depth.
+    EMBEDDING_EXECUTOR_WORKERS: int = int(
+        os.getenv("EMBEDDING_EXECUTOR_WORKERS", 2)
+    )
+    TORCH_NUM_THREADS: int = int(os.getenv("TORCH_NUM_THREADS", 0))
+    TORCH_NUM_INTEROP_THREADS: int = int(
+        os.getenv("TORCH_NUM_INTEROP_THREADS", 0)
+    )
+    # LRU cache of query embeddings; a TTL of 0 keeps entries until evicted.
+    EMBEDDING_CACHE_SIZE: int = int(os.getenv("EMBEDDING_CACHE_SIZE", 1024))
+    EMBEDDING_CACHE_TTL_SECONDS: float = float(
+        os.getenv("EMBEDDING_CACHE_TTL_SECONDS", 0)
+    )
+    # L2-normalize stored and query vectors. prepare_flags and the RAG tool
+    # both read this, so re-run prepare_flags after changing it.
+    EMBEDDING_NORMALIZE: bool = os.getenv(
+        "EMBEDDING_NORMALIZE", ""
+    ).lower() in ("1", "true", "yes")
+    # RAG retrieval answers from per-level in-memory vector matrices, checking
+    # the LanceDB table version at most every VECTOR_CACHE_REFRESH_SECONDS.
+    # Corpora larger than VECTOR_CACHE_MAX_ROWS are searched in LanceDB.
+    VECTOR_CACHE_MAX_ROWS: int = int(
+        os.getenv("VECTOR_CACHE_MAX_ROWS", 100_000)
+    )
+    VECTOR_CACHE_REFRESH_SECONDS: float = float(
+        os.getenv("VECTOR_CACHE_REFRESH_SECONDS", 5)
+    )
+    # How often (seconds) cached LanceDB table handles check for versions
+    # written by other processes; 0 checks on every read, -1 never.
+    LANCEDB_READ_CONSISTENCY_SECONDS: float = float(
+        os.getenv("LANCEDB_READ_CONSISTENCY_SECONDS", 5)
+    )
+    # prepare_flags always bitmap-indexes ctf_levels.level, and adds an IVF-PQ
+    # vector index once the table has LANCEDB_VECTOR_INDEX_MIN_ROWS rows
+    # (0 partitions / sub-vectors = derive from the row count / dimension).
+    LANCEDB_VECTOR_INDEX_MIN_ROWS: int = int(
+        os.getenv("LANCEDB_VECTOR_INDEX_MIN_ROWS", 10_000)
+    )
+    LANCEDB_IVF_PARTITIONS: int = int(os.getenv("LANCEDB_IVF_PARTITIONS", 0))
+    LANCEDB_PQ_SUB_VECTORS: int = int(os.getenv("LANCEDB_PQ_SUB_VECTORS", 0))
+    # Indexed RAG searches: IVF partitions probed and refine factor (re-rank
+    # refine_factor * limit candidates with exact distances; 0 disables).
+    RAG_NPROBES: int = int(os.getenv("RAG_NPROBES", 20))
+    RAG_REFINE_FACTOR: int = int(os.getenv("RAG_REFINE_FACTOR", 5))
+    # Frontend startup runs prepare_flags once per DEPLOYMENT_VERSION across
+    # all workers (file lock + readiness marker). Workers wait up to
+    # PREPARE_FLAGS_LOCK_TIMEOUT_SECONDS for the one preparing (0 = don't
+    # wait, serve read-only); keep it below gunicorn's --timeout (300s in
+    # supervisord.conf) or a waiting worker is killed before it gives up.
+    # PREPARE_FLAGS_BACKGROUND prepares after the server starts accepting
+    # requests instead of before.
+    DEPLOYMENT_VERSION: str = str(os.getenv("DEPLOYMENT_VERSION", ""))
+    PREPARE_FLAGS_LOCK_TIMEOUT_SECONDS: float = float(
+        os.getenv("PREPARE_FLAGS_LOCK_TIMEOUT_SECONDS", 240)
+    )
+    PREPARE_FLAGS_BACKGROUND: bool = os.getenv(
+        "PREPARE_FLAGS_BACKGROUND", ""
+    ).lower() in ("1", "true", "yes")
+    # prepare_flags embeds documents PREPARE_FLAGS_BATCH_SIZE at a time and
+    # streams each batch into LanceDB; more than one worker spreads batches
+    # over a process pool (one model copy per worker, for large corpora).
+    PREPARE_FLAGS_BATCH_SIZE: int = int(
+        os.getenv("PREPARE_FLAGS_BATCH_SIZE", 256)
+    )
+    PREPARE_FLAGS_EMBED_WORKERS: int = int(
+        os.getenv("PREPARE_FLAGS_EMBED_WORKERS", 1)
+    )
+    # RAG retrieval mode: "vector" (embed + vector search, the behaviour the
+    # levels are designed around), or opt in to "fts" (BM25 over the text FTS
+    # index only) or "hybrid" (FTS first, falling back to vector search when
+    # fewer than RAG_FTS_MIN_HITS of the level's documents match a keyword).
+    RAG_SEARCH_MODE: str = str(os.getenv("RAG_SEARCH_MODE", "vector")).lower()
+    RAG_FTS_MIN_HITS: int = int(os.getenv("RAG_FTS_MIN_HITS", 1))
+    # LRU cache of serialized password_search_func responses, keyed on
+    # (level, normalized question, table version); 0 disables it.
+    RAG_RESPONSE_CACHE_SIZE: int = int(
+        os.getenv("RAG_RESPONSE_CACHE_SIZE", 1024)
+    )
+    # The ADK process logs its RAG counters (see get_rag_stats) this
+    # often; 0 disables the log line.
+    RAG_STATS_LOG_INTERVAL_SECONDS: float = float(
+        os.getenv("RAG_STATS_LOG_INTERVAL_SECONDS", 300)
+    )
+    # "torch" (fp32 PyTorch) or "onnx" (int8-quantized ONNX Runtime). The
+    # ONNX model is exported on first use and must match torch's vectors
+    # to within EMBEDDING_ONNX_PARITY_THRESHOLD cosine similarity.
+    EMBEDDING_BACKEND: str = os.getenv("EMBEDDING_BACKEND", "torch")
+    EMBEDDING_ONNX_DIR: str = os.getenv(
+        "EMBEDDING_ONNX_DIR",
+        str(Path(__file__).resolve().parent / "onnx_models"),
+    )
+    EMBEDDING_ONNX_PARITY_THRESHOLD: float = float(
+        os.getenv("EMBEDDING_ONNX_PARITY_THRESHOLD", 0.98)
+    )
 
 
 settings = Settings()
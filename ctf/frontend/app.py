@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import random
@@ -23,7 +24,7 @@ from starlette.responses import Response as StarletteResponse
 
 from ctf.app_config import settings
 from ctf.llm_guard.llm_guard import PromptGuardMeta, PromptGuardGoose
-from ctf.prepare_flags import prepare_flags
+from ctf.prepare_flags import flags_ready, prepare_flags_once
 from ctf.prepare_hf_models import download_models
 from ctf.frontend.routes import challenges
 from ctf.frontend.routes import chat
@@ -67,9 +68,35 @@ class RegisterRequest(BaseModel):
     session_id: str | None = None
 
 
+PREPARE_FLAGS_ON_STARTUP = bool(os.getenv("PREPARE_FLAGS", False))
+
+
+def _prepare_flags_done(app: FastAPI, task: asyncio.Task) -> None:
+    """Log a failed background preparation and report it on /health."""
+    if task.cancelled():
+        return
+    error = task.exception()
+    if error is not None:
+        logger.error(
+            "Background flag preparation failed",
+            exc_info=(type(error), error, error.__traceback__),
+        )
+        app.prepare_flags_error = f"{type(error).__name__}: {error}"
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     app.requests_client = httpx.AsyncClient()
+    app.prepare_flags_error = None
+    if PREPARE_FLAGS_ON_STARTUP and settings.PREPARE_FLAGS_BACKGROUND:
+        # Serve requests immediately; the file lock still lets only one
+        # worker do the work.
+        app.prepare_flags_task = asyncio.create_task(
+            asyncio.to_thread(prepare_flags_once)
+        )
+        app.prepare_flags_task.add_done_callback(
+            lambda task: _prepare_flags_done(app, task)
+        )
     yield
     await app.requests_client.aclose()
 
@@ -79,8 +106,9 @@ logger = logging.getLogger(__name__)
 logging.getLogger("passlib").setLevel(logging.ERROR)
 os.environ["OPENAI_API_KEY"] = settings.OPENAI_API_KEY
 
-if bool(os.getenv("PREPARE_FLAGS", False)):
-    _ = prepare_flags(lancedb_persistent=True)
+if PREPARE_FLAGS_ON_STARTUP and not settings.PREPARE_FLAGS_BACKGROUND:
+    # Once per deployment version, however many gunicorn workers import this
+    _ = prepare_flags_once()
 
 download_models()
 
@@ -178,6 +206,17 @@ async def health(request: Request):  # noqa: F841
         "status": "healthy" if adk_healthy else "unhealthy",
         "url": adk_api_url,
     }
+    if PREPARE_FLAGS_ON_STARTUP:
+        prepare_flags_error = getattr(request.app, "prepare_flags_error", None)
+        if flags_ready():
+            health_status["services"]["flags"] = {"status": "ready"}
+        elif prepare_flags_error:
+            health_status["services"]["flags"] = {
+                "status": "failed",
+                "error": prepare_flags_error,
+            }
+        else:
+            health_status["services"]["flags"] = {"status": "preparing"}
     if adk_error:
         health_status["services"]["adk_api"]["error"] = adk_error
 
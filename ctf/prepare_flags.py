@@ -1,21 +1,75 @@
+import hashlib
+import json
 import os
+import time
 
 try:
     from ctf.app_config import settings
-    from ctf.embeddings import embed_texts
+    from ctf.embeddings import (
+        EMBEDDING_DIM,
+        EMBEDDING_MODEL_NAME,
+        resolve_model_revision,
+    )
+    from ctf.vector_store import refresh_table_handles
 except Exception:
     from app_config import settings
-    from embeddings import embed_texts
+    from embeddings import (
+        EMBEDDING_DIM,
+        EMBEDDING_MODEL_NAME,
+        resolve_model_revision,
+    )
+    from vector_store import refresh_table_handles
+import fcntl
+import multiprocessing
 import sqlite3
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import lancedb
+import numpy as np
+from lancedb.index import FTS, Bitmap, IvfPq
+import pyarrow as pa
+
+CTF_LEVELS_SCHEMA = pa.schema(
+    [
+        pa.field("id", pa.string()),
+        pa.field("text", pa.string()),
+        # all-MiniLM-L6-v2 produces 384-dim vectors
+        pa.field("vector", pa.list_(pa.float32(), EMBEDDING_DIM)),
+        pa.field("level", pa.int64()),
+        # SHA-256 of everything the row's vector depends on; see content_hash
+        pa.field("content_hash", pa.string()),
+    ]
+)
+
+
+def content_hash(text: str, level: int) -> str:
+    """
+    Hash a document together with the embedding config it is stored under.
+
+    The backend is the configured one, like deployment_version: resolving
+    it would load (and for ONNX export and parity-check) the model on every
+    run just to find that nothing changed. An ONNX deployment that fell back
+    to torch therefore keeps its torch vectors until the text changes.
+    """
+    key = "\0".join(
+        [
+            EMBEDDING_MODEL_NAME,
+            resolve_model_revision() or "unknown",
+            settings.EMBEDDING_BACKEND.lower(),
+            str(settings.EMBEDDING_NORMALIZE),
+            str(level),
+            text,
+        ]
+    )
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
 
 
 def setup_sql_level(PASSWORD: str):
 
     # Connecting to sqlite
     # connection object
-    connection_obj = sqlite3.connect("users.db")
+    connection_obj = sqlite3.connect(settings.USERS_DB_PATH)
 
     # cursor object
     cursor_obj = connection_obj.cursor()
@@ -67,19 +121,250 @@ def setup_sql_level(PASSWORD: str):
     print("Connection closed")
 
 
+def vector_index_name() -> str:
+    """
+    Name of the IVF-PQ index for the configured partitions / sub-vectors.
+
+    list_indices() does not report IVF parameters, so they are encoded in
+    the name; changing LANCEDB_IVF_PARTITIONS or LANCEDB_PQ_SUB_VECTORS then
+    shows up as a missing index. Derived partition counts ("auto") follow the
+    row count through optimize() rather than forcing a retrain.
+    """
+    num_partitions = settings.LANCEDB_IVF_PARTITIONS or "auto"
+    num_sub_vectors = settings.LANCEDB_PQ_SUB_VECTORS or EMBEDDING_DIM // 16
+    return f"vector_ivfpq_p{num_partitions}_s{num_sub_vectors}"
+
+
+def build_level_indexes(table) -> list[str]:
+    """
+    Index ctf_levels for filtered vector and full-text search.
+
+    A bitmap index on ``level`` (few distinct values) lets searches prefilter
+    by level without scanning, and an FTS index on ``text`` serves the RAG
+    tool's keyword lookups without embedding the question. Once the table
+    reaches LANCEDB_VECTOR_INDEX_MIN_ROWS rows an IVF-PQ index replaces the
+    brute-force vector scan; below that a flat scan is faster and exact.
+
+    Existing indexes are compared against that expected set, so only
+    missing or misconfigured ones are (re)built and an up-to-date table is
+    left untouched. Returns the names of the indexes built or dropped.
+    """
+    existing = {index.name: index for index in table.list_indices()}
+    by_column = {}
+    for index in existing.values():
+        for column in index.columns:
+            by_column.setdefault(column, []).append(index)
+    touched = []
+
+    for column, index_type, config in (
+        ("level", "Bitmap", Bitmap()),
+        ("text", "FTS", FTS()),
+    ):
+        indexes = by_column.get(column, [])
+        if [index.index_type for index in indexes] == [index_type]:
+            continue
+        for index in indexes:
+            table.drop_index(index.name)
+            touched.append(index.name)
+        table.create_index(column, config=config, replace=True)
+        touched.append(f"{column}_idx")
+
+    rows = table.count_rows()
+    name = vector_index_name()
+    wanted = rows >= settings.LANCEDB_VECTOR_INDEX_MIN_ROWS
+    vector_indexes = by_column.get("vector", [])
+    if [index.name for index in vector_indexes] == ([name] if wanted else []):
+        return touched
+    for index in vector_indexes:
+        table.drop_index(index.name)
+        touched.append(index.name)
+    if not wanted:
+        print(f"Skipping vector index for {rows} rows (flat search)")
+        return touched
+
+    # ~sqrt(rows) partitions and 16-dim PQ sub-vectors unless configured
+    num_partitions = settings.LANCEDB_IVF_PARTITIONS or max(1, int(rows**0.5))
+    num_sub_vectors = settings.LANCEDB_PQ_SUB_VECTORS or EMBEDDING_DIM // 16
+    table.create_index(
+        "vector",
+        config=IvfPq(
+            distance_type="l2",
+            num_partitions=num_partitions,
+            num_sub_vectors=num_sub_vectors,
+        ),
+        name=name,
+        replace=True,
+    )
+    touched.append(name)
+    print(
+        f"Built IVF-PQ index ({num_partitions} partitions, "
+        f"{num_sub_vectors} sub-vectors) over {rows} rows"
+    )
+    return touched
+
+
+def _embedded_batches(
+    ids, texts, levels, hashes, batch_size: int, workers: int
+):
+    """
+    Yield ctf_levels Arrow record batches of ``batch_size`` rows.
+
+    Each batch is embedded with one model call; with ``workers`` > 1 the
+    batches are spread over a spawned process pool (each worker loads its
+    own model, which only pays off for large corpora).
+    """
+    # Only imported once something needs embedding, so a no-op run never
+    # loads the model
+    try:
+        from ctf.embeddings import embed_texts_np
+    except Exception:
+        from embeddings import embed_texts_np
+
+    embed = partial(embed_texts_np, normalize=settings.EMBEDDING_NORMALIZE)
+    starts = range(0, len(texts), batch_size)
+    chunks = [texts[start : start + batch_size] for start in starts]
+
+    if workers > 1 and len(chunks) > 1:
+        pool = ProcessPoolExecutor(
+            max_workers=min(workers, len(chunks)),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+        vectors_iter = pool.map(embed, chunks)
+    else:
+        pool = None
+        vectors_iter = map(embed, chunks)
+
+    try:
+        for start, vectors in zip(starts, vectors_iter):
+            end = start + len(vectors)
+            yield pa.RecordBatch.from_arrays(
+                [
+                    pa.array(ids[start:end], type=pa.string()),
+                    pa.array(texts[start:end], type=pa.string()),
+                    pa.FixedSizeListArray.from_arrays(
+                        pa.array(
+                            np.asarray(vectors, dtype=np.float32).ravel(),
+                            type=pa.float32(),
+                        ),
+                        EMBEDDING_DIM,
+                    ),
+                    pa.array(levels[start:end], type=pa.int64()),
+                    pa.array(hashes[start:end], type=pa.string()),
+                ],
+                schema=CTF_LEVELS_SCHEMA,
+            )
+    finally:
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+
+
+def _embedded_reader(ids, texts, levels, hashes) -> pa.RecordBatchReader:
+    return pa.RecordBatchReader.from_batches(
+        CTF_LEVELS_SCHEMA,
+        _embedded_batches(
+            ids,
+            texts,
+            levels,
+            hashes,
+            batch_size=max(1, settings.PREPARE_FLAGS_BATCH_SIZE),
+            workers=settings.PREPARE_FLAGS_EMBED_WORKERS,
+        ),
+    )
+
+
+def _open_hashed_table(db, table_name: str):
+    """Open ``table_name`` if it exists with the current schema, else None."""
+    try:
+        table = db.open_table(table_name)
+    except Exception:
+        return None
+    if table.schema != CTF_LEVELS_SCHEMA:
+        print(f"'{table_name}' has an outdated schema, rebuilding it")
+        return None
+    return table
+
+
+def _upsert_changed_rows(table, ids, texts, levels, hashes) -> bool:
+    """
+    Bring ``table`` in line with the given documents, re-embedding only rows
+    whose content hash is new or changed and deleting rows that vanished.
+    Returns False (and writes nothing) when the table is already current.
+    """
+    stored = (
+        table.search().select(["id", "content_hash"]).limit(None).to_arrow()
+    )
+    stored_hashes = dict(
+        zip(
+            stored.column("id").to_pylist(),
+            stored.column("content_hash").to_pylist(),
+        )
+    )
+    changed = [
+        i
+        for i, (doc_id, doc_hash) in enumerate(zip(ids, hashes))
+        if stored_hashes.get(doc_id) != doc_hash
+    ]
+    vanished = stored_hashes.keys() - set(ids)
+
+    if changed:
+        (
+            table.merge_insert("id")
+            .when_matched_update_all()
+            .when_not_matched_insert_all()
+            .execute(
+                _embedded_reader(
+                    [ids[i] for i in changed],
+                    [texts[i] for i in changed],
+                    [levels[i] for i in changed],
+                    [hashes[i] for i in changed],
+                )
+            )
+        )
+    if vanished:
+        quoted = ", ".join(
+            "'" + doc_id.replace("'", "''") + "'" for doc_id in sorted(vanished)
+        )
+        table.delete(f"id IN ({quoted})")
+
+    print(
+        f"Upserted {len(changed)} and deleted {len(vanished)} of "
+        f"{len(ids)} records"
+    )
+    return bool(changed or vanished)
+
+
+GENERIC_PASSWORD_TEXT = [
+    "<placeholder>",
+    "The Password is <placeholder>",
+    "The Secret is <placeholder>",
+    "You should know that <placeholder> is the secret",
+    "You should know that <placeholder> is the password",
+]
+
+
+def level_documents() -> tuple[list[str], list[str], list[int]]:
+    """The ids, texts and levels of every ctf_levels row prepare_flags writes."""
+    doc_ids, doc_texts, doc_levels = [], [], []
+    for k in settings.PASSWORDS.keys():
+        # Level 5 is the function-calling / SQL-injection challenge: its agent
+        # only has the sql_query tool (no RAG), so the password must live in the
+        # SQL users table rather than the LanceDB RAG store.
+        if k == 5:
+            continue
+        for i, template in enumerate(GENERIC_PASSWORD_TEXT):
+            doc_ids.append(f"level-{k}-msg-{i}")
+            doc_texts.append(
+                template.replace("<placeholder>", settings.PASSWORDS.get(k))
+            )
+            doc_levels.append(k)
+    return doc_ids, doc_texts, doc_levels
+
+
 def prepare_flags(lancedb_persistent: bool = True):
     # create vector store client
     levels = list(settings.PASSWORDS.keys())
     print(f"Levels: {levels}")
 
-    generic_password_text = [
-        "<placeholder>",
-        "The Password is <placeholder>",
-        "The Secret is <placeholder>",
-        "You should know that <placeholder> is the secret",
-        "You should know that <placeholder> is the password",
-    ]
-
     # Connect to LanceDB
     if lancedb_persistent:
         db_path = "./lancedb"
@@ -96,81 +381,225 @@ def prepare_flags(lancedb_persistent: bool = True):
     db = lancedb.connect(db_path)
     table_name = "ctf_levels"
 
-    # Prepare all data for batch insertion
-    all_data = []
+    # Collect every document first so embedding runs in batches rather than
+    # one forward pass per row.
+    doc_ids, doc_texts, doc_levels = level_documents()
+    if 5 in settings.PASSWORDS:
+        setup_sql_level(settings.PASSWORDS.get(5))
 
-    for k in levels:
-        # Level 5 is the function-calling / SQL-injection challenge: its agent
-        # only has the sql_query tool (no RAG), so the password must live in the
-        # SQL users table rather than the LanceDB RAG store.
-        if k != 5:
-            _generic_password_text = generic_password_text
-            for i in range(0, len(_generic_password_text)):
-                text = _generic_password_text[i].replace(
-                    "<placeholder>", settings.PASSWORDS.get(k)
-                )
-                # Generate embedding for the text
-                vector = embed_texts([text])[0]
-
-                all_data.append(
-                    {
-                        "id": f"level-{k}-msg-{i}",
-                        "text": text,
-                        "vector": vector,
-                        "level": k,
-                    }
-                )
+    if doc_texts:
+        started = time.perf_counter()
+        doc_hashes = [
+            content_hash(text, level)
+            for text, level in zip(doc_texts, doc_levels)
+        ]
+        table = _open_hashed_table(db, table_name)
+        if table is None:
+            # Overwrite in place rather than drop + create: the dataset keeps
+            # a monotonically increasing version, which is what RAG readers
+            # in other processes compare to notice the rewrite.
+            table = db.create_table(
+                table_name,
+                data=_embedded_reader(
+                    doc_ids,
+                    doc_texts,
+                    doc_levels,
+                    doc_hashes,
+                ),
+                mode="overwrite",
+            )
+            print(f"Created table '{table_name}' with {len(doc_texts)} records")
+            changed = True
         else:
-            setup_sql_level(settings.PASSWORDS.get(k))
-
-    # Create or overwrite table with all data
-    if all_data:
-        try:
-            # Try to delete existing table if it exists
-            db.drop_table(table_name)
-        except Exception:
-            pass  # Table doesn't exist, that's fine
+            changed = _upsert_changed_rows(
+                table,
+                doc_ids,
+                doc_texts,
+                doc_levels,
+                doc_hashes,
+            )
+            if changed:
+                # Fold the upserted rows into the existing indexes instead
+                # of retraining them over the whole corpus
+                table.optimize()
 
-        # Create table with data
-        table = db.create_table(table_name, data=all_data, mode="overwrite")
+        # Checked on every run: a run that died before indexing, or changed
+        # index settings, must not leave the table unindexed for good
+        if build_level_indexes(table):
+            changed = True
+        if changed:
+            refresh_table_handles(db_path, table_name)
         print(
-            f"Created/updated table '{table_name}' with {len(all_data)} records"
+            f"Prepared '{table_name}' in "
+            f"{(time.perf_counter() - started) * 1000:.0f}ms"
         )
     else:
         # Open existing table or create empty one
         try:
             table = db.open_table(table_name)
         except Exception:
-            # Create empty table with schema
-            import pyarrow as pa
-
-            schema = pa.schema(
-                [
-                    pa.field("id", pa.string()),
-                    pa.field("text", pa.string()),
-                    pa.field(
-                        "vector", pa.list_(pa.float32(), 384)
-                    ),  # all-MiniLM-L6-v2 produces 384-dim vectors
-                    pa.field("level", pa.int64()),
-                ]
+            table = db.create_table(
+                table_name, schema=CTF_LEVELS_SCHEMA, mode="overwrite"
             )
-            table = db.create_table(table_name, schema=schema, mode="overwrite")
 
     return table
 
 
+PREPARE_LOCK_FILE = ".prepare_flags.lock"
+PREPARE_READY_FILE = ".prepare_flags.ready"
+# What prepare_flags writes; the marker alone does not prove these survived
+PREPARED_TABLE_DIR = "./lancedb/ctf_levels.lance"
+
+
+def deployment_version() -> str:
+    """
+    Identify what prepare_flags would build: DEPLOYMENT_VERSION (e.g. the
+    git hash) plus a fingerprint of the passwords, the generated documents,
+    the table schema and the embedding config, so changing any of them
+    re-runs preparation even without a new deploy tag. The backend is the
+    configured one: resolving it would load the model on every boot, and
+    content_hash already keys rows by the resolved backend.
+    """
+    doc_ids, doc_texts, _ = level_documents()
+    fingerprint = hashlib.sha256(
+        json.dumps(
+            [
+                sorted((str(k), v) for k, v in settings.PASSWORDS.items()),
+                doc_ids,
+                doc_texts,
+                CTF_LEVELS_SCHEMA.to_string(),
+                EMBEDDING_MODEL_NAME,
+                settings.EMBEDDING_NORMALIZE,
+                settings.EMBEDDING_BACKEND.lower(),
+            ]
+        ).encode("utf-8")
+    ).hexdigest()[:12]
+    return f"{settings.DEPLOYMENT_VERSION or 'dev'}-{fingerprint}"
+
+
+def _read_ready_version() -> str | None:
+    try:
+        with open(PREPARE_READY_FILE) as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError):
+        return None
+
+
+def _write_ready_version(version: str) -> None:
+    tmp = f"{PREPARE_READY_FILE}.{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(
+            {
+                "version": version,
+                "pid": os.getpid(),
+                "prepared_at": time.time(),
+            },
+            f,
+        )
+    os.replace(tmp, PREPARE_READY_FILE)
+
+
+def _prepared_outputs_exist() -> bool:
+    return os.path.isdir(PREPARED_TABLE_DIR) and os.path.exists(
+        settings.USERS_DB_PATH
+    )
+
+
+def _is_prepared(version: str) -> bool:
+    return _read_ready_version() == version and _prepared_outputs_exist()
+
+
+def flags_ready() -> bool:
+    """
+    True once this deployment version's flags have been prepared and the
+    LanceDB table and users.db are still on disk.
+    """
+    return _is_prepared(deployment_version())
+
+
+def prepare_flags_once(timeout: float | None = None) -> bool:
+    """
+    Run ``prepare_flags(lancedb_persistent=True)`` once per deployment
+    version across every process sharing the working directory.
+
+    The first caller takes an exclusive file lock, prepares the LanceDB table
+    and users.db, and writes a readiness marker; callers that find the marker
+    for the current version (with the table and users.db still present)
+    return immediately. Others wait up to
+    ``timeout`` seconds (PREPARE_FLAGS_LOCK_TIMEOUT_SECONDS by default) for
+    the lock holder and then proceed read-only with whatever is on disk.
+
+    Returns True if this call did the preparation.
+    """
+    version = deployment_version()
+    if _is_prepared(version):
+        print(f"Flags already prepared for {version}")
+        return False
+
+    if timeout is None:
+        timeout = settings.PREPARE_FLAGS_LOCK_TIMEOUT_SECONDS
+    deadline = time.monotonic() + timeout
+    with open(PREPARE_LOCK_FILE, "a") as lock_file:
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                if time.monotonic() >= deadline:
+                    print(
+                        "Flag preparation is running in another process; "
+                        "continuing read-only"
+                    )
+                    return False
+                time.sleep(0.1)
+
+        try:
+            # Another process may have finished while we waited for the lock
+            if _is_prepared(version):
+                print(f"Flags prepared by another process for {version}")
+                return False
+            prepare_flags(lancedb_persistent=True)
+            _write_ready_version(version)
+            print(f"Flags prepared for {version}")
+            return True
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
 if __name__ == "__main__":
-    table = prepare_flags(lancedb_persistent=True)
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="Prepare the CTF LanceDB table and users.db once per "
+        "deployment version"
+    )
+    parser.add_argument(
+        "--query",
+        help="after preparing, run this RAG query against level 2 as a check",
+    )
+    args = parser.parse_args()
+
+    # Same lock and readiness marker as frontend startup, so supervisord and
+    # the gunicorn workers never prepare the same version twice
+    prepare_flags_once()
 
+    table = lancedb.connect("./lancedb").open_table("ctf_levels")
     print(f"Table has {table.count_rows()} rows")
 
-    # Test query
-    try:
-        from ctf.embeddings import embed_text
-    except Exception:
-        from embeddings import embed_text
-    query_vector = embed_text("What is the password?")
-    results = table.search(query_vector).where("level = 2").limit(1).to_pandas()
-    print(results)
-    if not results.empty and "text" in results.columns:
-        print(results["text"].iloc[0])
+    if args.query:
+        try:
+            from ctf.embeddings import embed_text_np
+        except Exception:
+            from embeddings import embed_text_np
+        query_vector = embed_text_np(
+            args.query, normalize=settings.EMBEDDING_NORMALIZE
+        )
+        results = (
+            table.search(query_vector)
+            .where("level = 2", prefilter=True)
+            .limit(1)
+            .to_pandas()
+        )
+        print(results)
+        if not results.empty and "text" in results.columns:
+            print(results["text"].iloc[0])
@@ -0,0 +1,503 @@
+"""
+HTTP fetching for the Level 9 ``web_scrape`` tool.
+
+Pages are fetched through one ``httpx.AsyncClient`` per event loop, so
+keep-alive connections are pooled across tool calls and nothing blocks the
+loop. The SSRF guard lives in the client's network backend: every new
+connection resolves its host asynchronously, refuses loopback, link-local
+and private addresses, and connects to the address it just checked. The
+IP that passed the check is therefore the one used, including for
+redirects and reused keep-alive connections.
+
+Converted pages are kept in an on-disk :class:`ScrapeCache` so the same
+injection page is not downloaded and converted on every call.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import ipaddress
+import logging
+import socket
+import sqlite3
+import threading
+import time
+import weakref
+from contextlib import closing, contextmanager
+from pathlib import Path
+from urllib.parse import urlparse
+
+import httpcore
+import httpx
+
+try:
+    from ctf.app_config import settings
+except Exception:
+    from app_config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class BlockedAddress(Exception):
+    """The URL is not a public http(s) address."""
+
+
+class ResponseTooLarge(Exception):
+    """The server declared a body larger than the scrape cap."""
+
+
+def _is_blocked_ip(ip: ipaddress.IPv4Address | ipaddress.IPv6Address) -> bool:
+    return ip.is_loopback or ip.is_link_local or ip.is_private
+
+
+async def resolve_public_addresses(
+    host: str, port: int, timeout: float | None = None
+) -> list[str]:
+    """
+    Resolve ``host`` without blocking the event loop and return the
+    addresses to connect to, in resolver order. Raises
+    :class:`BlockedAddress` if the host does not resolve or any of its
+    addresses is non-public, so a DNS answer mixing public and internal
+    records cannot slip through.
+    """
+    try:
+        addresses = [str(ipaddress.ip_address(host))]
+    except ValueError:
+        loop = asyncio.get_running_loop()
+        try:
+            infos = await asyncio.wait_for(
+                loop.getaddrinfo(host, port, type=socket.SOCK_STREAM),
+                timeout,
+            )
+        except (socket.gaierror, asyncio.TimeoutError) as e:
+            raise BlockedAddress(
+                f"could not resolve host '{host}': {e or 'timed out'}"
+            ) from None
+        addresses = list(dict.fromkeys(info[4][0] for info in infos))
+
+    for address in addresses:
+        # Scoped IPv6 addresses carry a "%iface" suffix
+        if _is_blocked_ip(ipaddress.ip_address(address.split("%")[0])):
+            raise BlockedAddress(
+                f"URL resolves to a disallowed address ({address})"
+            )
+    return addresses
+
+
+class PublicAddressBackend(httpcore.AsyncNetworkBackend):
+    """Network backend that only opens TCP connections to public IPs."""
+
+    def __init__(self):
+        self._backend = httpcore.AnyIOBackend()
+
+    async def connect_tcp(
+        self,
+        host: str,
+        port: int,
+        timeout: float | None = None,
+        local_address: str | None = None,
+        socket_options=None,
+    ) -> httpcore.AsyncNetworkStream:
+        addresses = await resolve_public_addresses(host, port, timeout)
+        # Every address was vetted above; try them in order so one
+        # unreachable record (e.g. IPv6 without a route) does not fail the
+        # fetch. TLS still verifies against the hostname: httpcore passes
+        # the request's host as server_hostname when it upgrades the stream
+        for address in addresses:
+            try:
+                return await self._backend.connect_tcp(
+                    address,
+                    port,
+                    timeout=timeout,
+                    local_address=local_address,
+                    socket_options=socket_options,
+                )
+            except (httpcore.ConnectError, httpcore.ConnectTimeout) as e:
+                logger.debug(f"Could not connect to {host} at {address}: {e}")
+                error = e
+        raise error
+
+    async def connect_unix_socket(
+        self, path: str, timeout: float | None = None, socket_options=None
+    ) -> httpcore.AsyncNetworkStream:
+        raise BlockedAddress("unix sockets are not allowed")
+
+    async def sleep(self, seconds: float) -> None:
+        await self._backend.sleep(seconds)
+
+
+# httpcore exceptions surfaced as their httpx equivalents, so callers only
+# ever see httpx.HTTPError subclasses. Looked up along the exception's MRO.
+_HTTPCORE_ERRORS = {
+    httpcore.ConnectTimeout: httpx.ConnectTimeout,
+    httpcore.ReadTimeout: httpx.ReadTimeout,
+    httpcore.WriteTimeout: httpx.WriteTimeout,
+    httpcore.PoolTimeout: httpx.PoolTimeout,
+    httpcore.TimeoutException: httpx.TimeoutException,
+    httpcore.ConnectError: httpx.ConnectError,
+    httpcore.ReadError: httpx.ReadError,
+    httpcore.WriteError: httpx.WriteError,
+    httpcore.NetworkError: httpx.NetworkError,
+    httpcore.UnsupportedProtocol: httpx.UnsupportedProtocol,
+    httpcore.RemoteProtocolError: httpx.RemoteProtocolError,
+    httpcore.LocalProtocolError: httpx.LocalProtocolError,
+    httpcore.ProtocolError: httpx.ProtocolError,
+}
+
+
+@contextmanager
+def _httpx_errors(request: httpx.Request):
+    try:
+        yield
+    except Exception as e:
+        for cls in type(e).__mro__:
+            mapped = _HTTPCORE_ERRORS.get(cls)
+            if mapped is not None:
+                raise mapped(str(e), request=request) from e
+        raise
+
+
+class _PoolResponseStream(httpx.AsyncByteStream):
+    def __init__(self, stream, request: httpx.Request):
+        self._stream = stream
+        self._request = request
+
+    async def __aiter__(self):
+        with _httpx_errors(self._request):
+            async for chunk in self._stream:
+                yield chunk
+
+    async def aclose(self) -> None:
+        if hasattr(self._stream, "aclose"):
+            with _httpx_errors(self._request):
+                await self._stream.aclose()
+
+
+class PublicAddressTransport(httpx.AsyncBaseTransport):
+    """
+    Transport over an ``httpcore.AsyncConnectionPool`` that connects through
+    PublicAddressBackend. Only httpcore's public API is used: the pool is
+    built here rather than swapped into an ``AsyncHTTPTransport``.
+    """
+
+    def __init__(self, limits: httpx.Limits):
+        self._pool = httpcore.AsyncConnectionPool(
+            ssl_context=httpx.create_ssl_context(),
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+            network_backend=PublicAddressBackend(),
+        )
+
+    async def handle_async_request(
+        self, request: httpx.Request
+    ) -> httpx.Response:
+        core_request = httpcore.Request(
+            method=request.method,
+            url=httpcore.URL(
+                scheme=request.url.raw_scheme,
+                host=request.url.raw_host,
+                port=request.url.port,
+                target=request.url.raw_path,
+            ),
+            headers=request.headers.raw,
+            content=request.stream,
+            extensions=request.extensions,
+        )
+        with _httpx_errors(request):
+            response = await self._pool.handle_async_request(core_request)
+        return httpx.Response(
+            status_code=response.status,
+            headers=response.headers,
+            stream=_PoolResponseStream(response.stream, request),
+            extensions=response.extensions,
+        )
+
+    async def aclose(self) -> None:
+        await self._pool.aclose()
+
+
+_clients: weakref.WeakKeyDictionary = weakref.WeakKeyDictionary()
+_clients_lock = threading.Lock()
+
+
+def get_scrape_client() -> httpx.AsyncClient:
+    """
+    The shared client for the running event loop. httpx connections belong
+    to the loop that opened them, hence one client per loop.
+    """
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None or client.is_closed:
+        with _clients_lock:
+            client = _clients.get(loop)
+            if client is None or client.is_closed:
+                client = httpx.AsyncClient(
+                    transport=PublicAddressTransport(
+                        httpx.Limits(
+                            max_connections=settings.WEB_SCRAPE_MAX_CONNECTIONS,
+                            max_keepalive_connections=(
+                                settings.WEB_SCRAPE_MAX_KEEPALIVE
+                            ),
+                        )
+                    ),
+                    timeout=settings.WEB_SCRAPE_TIMEOUT_SECONDS,
+                    follow_redirects=True,
+                    max_redirects=settings.WEB_SCRAPE_MAX_REDIRECTS,
+                    # Proxies from the environment would bypass the SSRF guard
+                    trust_env=False,
+                )
+                _clients[loop] = client
+    return client
+
+
+def check_url(url: str) -> None:
+    """Reject non-http(s) URLs before any network work."""
+    parsed = urlparse(url)
+    if parsed.scheme not in ("http", "https"):
+        raise BlockedAddress(f"unsupported URL scheme '{parsed.scheme}'")
+    if not parsed.hostname:
+        raise BlockedAddress("URL has no hostname")
+
+
+async def fetch_page(
+    url: str, max_bytes: int, headers: dict | None = None
+) -> tuple[httpx.Response, str]:
+    """
+    GET ``url`` and return the (closed) response with its body decoded,
+    reading at most ``max_bytes``. Raises :class:`BlockedAddress` for
+    non-public targets, ``httpx.HTTPError`` for network and HTTP errors
+    and :class:`ResponseTooLarge` for a declared Content-Length above
+    ``max_bytes``.
+    """
+    check_url(url)
+    async with get_scrape_client().stream(
+        "GET", url, headers=headers
+    ) as response:
+        if response.status_code == 304:
+            # Answer to a conditional request: no body, the cached copy holds
+            return response, ""
+        response.raise_for_status()
+
+        content_length = response.headers.get("Content-Length")
+        if content_length and int(content_length) > max_bytes:
+            raise ResponseTooLarge(
+                f"response too large ({content_length} bytes)"
+            )
+
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body.extend(chunk)
+            if len(body) >= max_bytes:
+                del body[max_bytes:]
+                break
+
+    encoding = response.charset_encoding or "utf-8"
+    try:
+        text = bytes(body).decode(encoding, errors="replace")
+    except LookupError:
+        text = bytes(body).decode("utf-8", errors="replace")
+    return response, text
+
+
+def cache_lifetime(headers: httpx.Headers, ttl_seconds: float) -> float | None:
+    """
+    Seconds a response may be served from the cache without revalidating,
+    per its Cache-Control header and capped at ``ttl_seconds``. None means
+    the page must not be cached at all: ``no-store``, and also ``private``,
+    since this cache is shared by every player. ``no-cache`` and
+    ``max-age=0`` give 0, i.e. cache but revalidate on every use.
+    """
+    directives = {}
+    for directive in headers.get("Cache-Control", "").split(","):
+        name, _, value = directive.strip().partition("=")
+        directives[name.strip().lower()] = value.strip().strip('"')
+
+    if "no-store" in directives or "private" in directives:
+        return None
+    if "no-cache" in directives:
+        return 0.0
+    try:
+        return max(0.0, min(float(directives["max-age"]), ttl_seconds))
+    except (KeyError, ValueError):
+        return ttl_seconds
+
+
+class ScrapeCache:
+    """
+    On-disk cache of converted pages, shared by every process through one
+    SQLite file.
+
+    Each entry holds the markdown with the response's ETag and
+    Last-Modified. Entries younger than their lifetime (``ttl_seconds``, or
+    less if the server's Cache-Control says so; see :func:`cache_lifetime`)
+    are served as is; older ones are revalidated with a conditional GET, and
+    a 304 renews them without downloading or converting again. Once the
+    stored markdown exceeds ``max_bytes``, the least recently used pages are
+    evicted.
+    """
+
+    # Bumped whenever the pages table changes; older files are rebuilt
+    SCHEMA_VERSION = 2
+
+    def __init__(self, path: str | Path, max_bytes: int, ttl_seconds: float):
+        self.path = Path(path)
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._initialized = False
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.path, timeout=5)
+        if not self._initialized:
+            connection.execute("PRAGMA journal_mode=WAL")
+            with connection:
+                (version,) = connection.execute(
+                    "PRAGMA user_version"
+                ).fetchone()
+                if version != self.SCHEMA_VERSION:
+                    connection.execute("DROP TABLE IF EXISTS pages")
+                    connection.execute(
+                        f"PRAGMA user_version = {self.SCHEMA_VERSION}"
+                    )
+                connection.execute(
+                    """CREATE TABLE IF NOT EXISTS pages (
+                        url TEXT PRIMARY KEY,
+                        markdown TEXT NOT NULL,
+                        etag TEXT,
+                        last_modified TEXT,
+                        size INTEGER NOT NULL,
+                        fetched_at REAL NOT NULL,
+                        expires_at REAL NOT NULL,
+                        last_used REAL NOT NULL
+                    )"""
+                )
+            self._initialized = True
+        return connection
+
+    def get(self, url: str) -> tuple[str, str | None, str | None, bool] | None:
+        """
+        Return ``(markdown, etag, last_modified, fresh)`` for ``url``, or
+        None if it is not cached. ``fresh`` is False once the entry has
+        outlived its lifetime and needs revalidating.
+        """
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            row = connection.execute(
+                "SELECT markdown, etag, last_modified, expires_at "
+                "FROM pages WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            connection.execute(
+                "UPDATE pages SET last_used = ? WHERE url = ?", (now, url)
+            )
+        markdown, etag, last_modified, expires_at = row
+        fresh = now < expires_at
+        if fresh:
+            self.hits += 1
+        return markdown, etag, last_modified, fresh
+
+    def put(
+        self,
+        url: str,
+        markdown: str,
+        etag: str | None,
+        last_modified: str | None,
+        lifetime: float | None = None,
+    ) -> None:
+        """
+        Store ``url``'s markdown, fresh for ``lifetime`` seconds (the TTL by
+        default), then evict down to ``max_bytes``.
+        """
+        size = len(markdown.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if lifetime is None:
+            lifetime = self.ttl_seconds
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    markdown,
+                    etag,
+                    last_modified,
+                    size,
+                    now,
+                    now + lifetime,
+                    now,
+                ),
+            )
+            connection.execute(
+                """DELETE FROM pages WHERE url IN (
+                    SELECT url FROM (
+                        SELECT url, SUM(size) OVER (
+                            ORDER BY last_used DESC, url
+                        ) AS running
+                        FROM pages
+                    ) WHERE running > ?
+                )""",
+                (self.max_bytes,),
+            )
+
+    def renew(self, url: str, lifetime: float | None = None) -> None:
+        """Mark ``url`` fresh again after the server answered 304."""
+        if lifetime is None:
+            lifetime = self.ttl_seconds
+        now = time.time()
+        with closing(self._connect()) as connection, connection:
+            connection.execute(
+                "UPDATE pages SET fetched_at = ?, expires_at = ?, last_used = ? "
+                "WHERE url = ?",
+                (now, now + lifetime, now, url),
+            )
+        self.revalidated += 1
+
+    def stats(self) -> dict:
+        with closing(self._connect()) as connection:
+            pages, size = connection.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM pages"
+            ).fetchone()
+        lookups = self.hits + self.revalidated + self.misses
+        return {
+            "path": str(self.path),
+            "pages": pages,
+            "bytes": size,
+            "hits": self.hits,
+            "revalidated": self.revalidated,
+            "misses": self.misses,
+            "hit_rate": (
+                round((self.hits + self.revalidated) / lookups, 3)
+                if lookups
+                else 0.0
+            ),
+        }
+
+
+_scrape_caches: dict[Path, ScrapeCache] = {}
+_scrape_caches_lock = threading.Lock()
+
+
+def get_scrape_cache() -> ScrapeCache | None:
+    """The cache at WEB_SCRAPE_CACHE_PATH, or None if disabled."""
+    if not settings.WEB_SCRAPE_CACHE_PATH:
+        return None
+    path = Path(settings.WEB_SCRAPE_CACHE_PATH).resolve()
+    cache = _scrape_caches.get(path)
+    if cache is None:
+        with _scrape_caches_lock:
+            cache = _scrape_caches.setdefault(
+                path,
+                ScrapeCache(
+                    path,
+                    settings.WEB_SCRAPE_CACHE_MAX_BYTES,
+                    settings.WEB_SCRAPE_CACHE_TTL_SECONDS,
+                ),
+            )
+    return cache
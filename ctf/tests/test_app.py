@@ -1,6 +1,10 @@
+import time
+
 import pytest
 from fastapi.testclient import TestClient
 
+from ctf.app_config import settings
+from ctf.frontend import app as app_module
 from ctf.frontend.app import app
 
 client = TestClient(app)
@@ -15,6 +19,27 @@ def test_health():
     assert "services" in data
 
 
+def test_health_reports_failed_flag_preparation(monkeypatch):
+    def failing_prepare():
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(app_module, "PREPARE_FLAGS_ON_STARTUP", True)
+    monkeypatch.setattr(settings, "PREPARE_FLAGS_BACKGROUND", True)
+    monkeypatch.setattr(app_module, "prepare_flags_once", failing_prepare)
+    monkeypatch.setattr(app_module, "flags_ready", lambda: False)
+    monkeypatch.setattr(app, "prepare_flags_error", None, raising=False)
+
+    # Entering the client runs the app's lifespan, which starts preparation
+    with TestClient(app) as lifespan_client:
+        for _ in range(500):
+            flags = lifespan_client.get("/health").json()["services"]["flags"]
+            if flags["status"] != "preparing":
+                break
+            time.sleep(0.01)
+
+    assert flags == {"status": "failed", "error": "RuntimeError: disk full"}
+
+
 def test_root():
     response = client.get("/")
     assert response.status_code == 200
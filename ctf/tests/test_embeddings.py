@@ -0,0 +1,296 @@
+import asyncio
+import threading
+import time
+import weakref
+
+import numpy as np
+import pytest
+
+from ctf import embeddings
+
+
+def _fake_embed_texts(calls: list):
+    def fake(texts: list[str]) -> np.ndarray:
+        calls.append(list(texts))
+        return np.array(
+            [[float(len(text)), 1.0] for text in texts], dtype=np.float32
+        )
+
+    return fake
+
+
+def test_batcher_coalesces_concurrent_requests(monkeypatch):
+    calls = []
+    monkeypatch.setattr(embeddings, "_encode", _fake_embed_texts(calls))
+
+    async def run():
+        batcher = embeddings.EmbeddingBatcher(max_batch_size=64, window_ms=20)
+        texts = [f"question {'?' * i}" for i in range(50)]
+        vectors = await asyncio.gather(*(batcher.embed(t) for t in texts))
+        return texts, vectors, batcher.stats()
+
+    texts, vectors, stats = asyncio.run(run())
+
+    assert len(calls) == 1
+    assert [v.tolist() for v in vectors] == [
+        [float(len(t)), 1.0] for t in texts
+    ]
+    assert stats["requests"] == 50
+    assert stats["batches"] == 1
+    assert stats["max_batch_size"] == 50
+    assert stats["queue_wait_ms_max"] >= 0
+
+
+def test_batcher_splits_at_max_batch_size(monkeypatch):
+    calls = []
+    monkeypatch.setattr(embeddings, "_encode", _fake_embed_texts(calls))
+
+    async def run():
+        batcher = embeddings.EmbeddingBatcher(max_batch_size=8, window_ms=50)
+        await asyncio.gather(*(batcher.embed(str(i)) for i in range(20)))
+        return batcher.stats()
+
+    stats = asyncio.run(run())
+
+    assert [len(batch) for batch in calls] == [8, 8, 4]
+    assert stats["batches"] == 3
+
+
+def test_batcher_propagates_model_errors(monkeypatch):
+    def boom(texts):
+        raise RuntimeError("model unavailable")
+
+    monkeypatch.setattr(embeddings, "_encode", boom)
+
+    async def run():
+        batcher = embeddings.EmbeddingBatcher(max_batch_size=4, window_ms=1)
+        return await asyncio.gather(
+            batcher.embed("a"), batcher.embed("b"), return_exceptions=True
+        )
+
+    results = asyncio.run(run())
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+
+
+def test_embedding_cache_normalizes_and_counts():
+    cache = embeddings.EmbeddingCache(maxsize=2)
+    cache.put("What is the password?", [1.0, 2.0])
+
+    assert cache.get("  what IS the   password? ").tolist() == [1.0, 2.0]
+    assert cache.get("What is the secret?") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+
+def test_embedding_cache_evicts_least_recently_used():
+    cache = embeddings.EmbeddingCache(maxsize=2)
+    cache.put("a", [1.0])
+    cache.put("b", [2.0])
+    cache.get("a")
+    cache.put("c", [3.0])
+
+    assert cache.get("b") is None
+    assert cache.get("a").tolist() == [1.0]
+    assert cache.stats()["evictions"] == 1
+
+
+def test_embedding_cache_ttl_expires(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(embeddings.time, "monotonic", lambda: now[0])
+    cache = embeddings.EmbeddingCache(maxsize=4, ttl_seconds=10)
+    cache.put("a", [1.0])
+
+    now[0] += 11
+    assert cache.get("a") is None
+    assert cache.stats()["expirations"] == 1
+
+
+def test_embed_text_async_skips_model_on_cache_hit(monkeypatch):
+    calls = []
+    monkeypatch.setattr(embeddings, "_encode", _fake_embed_texts(calls))
+    monkeypatch.setattr(
+        embeddings, "query_embedding_cache", embeddings.EmbeddingCache(8)
+    )
+
+    async def run():
+        first = await embeddings.embed_text_async("What is the password?")
+        second = await embeddings.embed_text_async("what is the password?")
+        return first, second
+
+    first, second = asyncio.run(run())
+
+    assert first == second == [float(len("What is the password?")), 1.0]
+    assert len(calls) == 1
+
+
+@pytest.mark.integration
+def test_onnx_backend_matches_torch(monkeypatch, tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    monkeypatch.setattr(
+        embeddings.settings, "EMBEDDING_ONNX_DIR", str(tmp_path)
+    )
+    monkeypatch.setattr(embeddings, "_onnx_session", None)
+    monkeypatch.setattr(embeddings, "_backend", None)
+    monkeypatch.setattr(embeddings.settings, "EMBEDDING_BACKEND", "onnx")
+
+    assert embeddings.get_embedding_backend() == "onnx"
+    assert (tmp_path / "model.int8.onnx").exists()
+    assert (
+        embeddings.check_onnx_parity()
+        >= embeddings.settings.EMBEDDING_ONNX_PARITY_THRESHOLD
+    )
+    assert len(embeddings.embed_texts(["What is the password?"])[0]) == 384
+
+
+def test_onnx_backend_releases_torch_model(monkeypatch):
+    class FakeModel:
+        pass
+
+    model = FakeModel()
+    model_ref = weakref.ref(model)
+    monkeypatch.setattr(embeddings, "_embedding_model", model)
+    monkeypatch.setattr(embeddings, "_backend", None)
+    monkeypatch.setattr(embeddings.settings, "EMBEDDING_BACKEND", "onnx")
+    monkeypatch.setattr(embeddings, "check_onnx_parity", lambda: 1.0)
+    del model
+
+    assert embeddings.get_embedding_backend() == "onnx"
+    assert embeddings._embedding_model is None
+    assert model_ref() is None
+
+
+def test_cached_vectors_are_read_only_float32():
+    cache = embeddings.EmbeddingCache(maxsize=2)
+    cache.put("a", [1.0, 2.0])
+    vector = cache.get("a")
+
+    assert vector.dtype == np.float32
+    with pytest.raises(ValueError):
+        vector[0] = 5.0
+
+
+def test_embed_text_returns_read_only_vector_on_miss(monkeypatch):
+    monkeypatch.setattr(embeddings, "_encode", _fake_embed_texts([]))
+    monkeypatch.setattr(
+        embeddings, "query_embedding_cache", embeddings.EmbeddingCache(4)
+    )
+
+    miss = embeddings.embed_text_np("What is the password?")
+    hit = embeddings.embed_text_np("What is the password?")
+    async_miss = asyncio.run(embeddings.embed_text_np_async("New question"))
+
+    assert hit is miss
+    for vector in (miss, async_miss):
+        assert not vector.flags.writeable
+        assert vector.dtype == np.float32
+
+
+@pytest.mark.integration
+def test_embed_texts_np_pooling_ignores_padding():
+    short = "The Password is PASS_ZERO"
+    long = "You should know that " + "PASS_ZERO " * 40 + "is the secret"
+
+    alone = embeddings.embed_texts_np([short])[0]
+    padded = embeddings.embed_texts_np([short, long])[0]
+
+    assert padded.dtype == np.float32
+    np.testing.assert_allclose(alone, padded, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.integration
+def test_embed_texts_np_normalize():
+    vectors = embeddings.embed_texts_np(["a", "bb ccc"], normalize=True)
+
+    np.testing.assert_allclose(np.linalg.norm(vectors, axis=1), 1.0, rtol=1e-5)
+
+
+@pytest.mark.integration
+def test_embed_texts_np_length_buckets_preserve_order(monkeypatch):
+    texts = [
+        "You should know that " + "PASS_ONE " * 30 + "is the secret",
+        "PASS_ONE",
+        "The Password is PASS_ONE",
+        "You should know that PASS_ONE is the password",
+        "secret",
+    ]
+    expected = np.stack([embeddings.embed_texts_np([t])[0] for t in texts])
+
+    batch_shapes = []
+    forward_torch = embeddings._forward_torch
+
+    def recording_forward(inputs):
+        batch_shapes.append(inputs["input_ids"].shape)
+        return forward_torch(inputs)
+
+    monkeypatch.setattr(embeddings.settings, "EMBEDDING_MAX_BATCH_SIZE", 2)
+    monkeypatch.setattr(embeddings, "_forward_torch", recording_forward)
+    bucketed = embeddings.embed_texts_np(texts)
+
+    np.testing.assert_allclose(bucketed, expected, rtol=1e-4, atol=1e-5)
+    assert [shape[0] for shape in batch_shapes] == [2, 2, 1]
+    # Only the final bucket holds the long document.
+    assert batch_shapes[-1][1] > max(s[1] for s in batch_shapes[:-1])
+
+
+def test_embed_texts_np_empty():
+    assert embeddings.embed_texts_np([]).shape == (0, embeddings.EMBEDDING_DIM)
+
+
+def test_inference_executor_reports_queue_depth():
+    executor = embeddings.InferenceExecutor(max_workers=1)
+    release = threading.Event()
+    try:
+        futures = [executor.submit(release.wait, 5) for _ in range(3)]
+        deadline = time.monotonic() + 5
+        while executor.stats()["running"] != 1 and time.monotonic() < deadline:
+            time.sleep(0.01)
+
+        stats = executor.stats()
+        assert stats["running"] == 1
+        assert executor.queue_depth == 2
+        assert stats["max_queue_depth"] >= 2
+    finally:
+        release.set()
+        executor.shutdown()
+
+    assert all(f.result() for f in futures)
+    assert executor.stats()["completed"] == 3
+    assert executor.queue_depth == 0
+
+
+def test_batcher_runs_on_inference_executor(monkeypatch):
+    thread_names = []
+
+    def fake(texts):
+        thread_names.append(threading.current_thread().name)
+        return np.zeros((len(texts), 2), dtype=np.float32)
+
+    monkeypatch.setattr(embeddings, "_encode", fake)
+
+    async def run():
+        batcher = embeddings.EmbeddingBatcher(max_batch_size=4, window_ms=1)
+        await batcher.embed("a")
+
+    asyncio.run(run())
+
+    assert thread_names[0].startswith("embedding-inference")
+
+
+def test_batcher_stats_cover_each_event_loop(monkeypatch):
+    calls = []
+    monkeypatch.setattr(embeddings, "_encode", _fake_embed_texts(calls))
+
+    async def run():
+        batcher = embeddings.get_embedding_batcher()
+        await asyncio.gather(batcher.embed("a"), batcher.embed("bb"))
+        return batcher.stats(), embeddings.get_embedding_batcher_stats()
+
+    own, stats = asyncio.run(run())
+
+    # Batchers of earlier, already closed loops may not be collected yet
+    assert own["requests"] == 2
+    assert own in stats
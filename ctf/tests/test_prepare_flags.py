@@ -0,0 +1,289 @@
+import fcntl
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pyarrow as pa
+import pytest
+
+from ctf import embeddings as embeddings_module
+from ctf import prepare_flags as prepare_flags_module
+from ctf.app_config import settings
+from ctf.embeddings import embed_texts_np
+
+
+@pytest.mark.integration
+def test_prepare_flags_embeds_in_batches(tmp_path, monkeypatch):
+    calls = []
+
+    def recording_embed(texts, normalize=False):
+        calls.append(len(texts))
+        return embed_texts_np(texts, normalize=normalize)
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(embeddings_module, "embed_texts_np", recording_embed)
+    monkeypatch.setattr(settings, "PREPARE_FLAGS_BATCH_SIZE", 16)
+
+    table = prepare_flags_module.prepare_flags(lancedb_persistent=True)
+
+    rag_levels = [level for level in settings.PASSWORDS if level != 5]
+    assert table.count_rows() == 5 * len(rag_levels)
+    assert sum(calls) == table.count_rows()
+    assert max(calls) == 16
+    assert table.schema == prepare_flags_module.CTF_LEVELS_SCHEMA
+
+
+@pytest.mark.integration
+def test_embedded_batches_process_pool_matches_serial():
+    texts = [f"The Password is PASS_{i}" for i in range(6)]
+    ids = [f"doc-{i}" for i in range(6)]
+    levels = [i % 2 for i in range(6)]
+    hashes = [str(i) for i in range(6)]
+
+    serial = list(
+        prepare_flags_module._embedded_batches(
+            ids, texts, levels, hashes, batch_size=4, workers=1
+        )
+    )
+    pooled = list(
+        prepare_flags_module._embedded_batches(
+            ids, texts, levels, hashes, batch_size=4, workers=2
+        )
+    )
+
+    assert [batch.num_rows for batch in pooled] == [4, 2]
+    for a, b in zip(serial, pooled):
+        assert a.column("id") == b.column("id")
+        assert a.column("content_hash") == b.column("content_hash")
+        np.testing.assert_allclose(
+            a.column("vector").values.to_numpy(),
+            b.column("vector").values.to_numpy(),
+            rtol=1e-4,
+            atol=1e-5,
+        )
+
+
+def _recording_embed(calls):
+    def recording_embed(texts, normalize=False):
+        calls.append(list(texts))
+        return embed_texts_np(texts, normalize=normalize)
+
+    return recording_embed
+
+
+@pytest.mark.integration
+def test_prepare_flags_noop_rerun_skips_embedding(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    table = prepare_flags_module.prepare_flags(lancedb_persistent=True)
+    version = table.version
+
+    calls = []
+    monkeypatch.setattr(
+        embeddings_module, "embed_texts_np", _recording_embed(calls)
+    )
+
+    def no_model(*args, **kwargs):
+        raise AssertionError("a no-op run must not load the model")
+
+    # Neither encoding nor resolving the backend (an ONNX export and parity
+    # check) may happen
+    monkeypatch.setattr(embeddings_module, "_encode", no_model)
+    monkeypatch.setattr(embeddings_module, "get_embedding_backend", no_model)
+    table = prepare_flags_module.prepare_flags(lancedb_persistent=True)
+
+    assert calls == []
+    assert table.version == version
+
+
+@pytest.mark.integration
+def test_prepare_flags_upserts_changed_and_deletes_vanished(
+    tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    prepare_flags_module.prepare_flags(lancedb_persistent=True)
+
+    passwords = dict(settings.PASSWORDS)
+    passwords[2] = "PASS_CHANGED"
+    del passwords[3]
+    monkeypatch.setattr(settings, "PASSWORDS", passwords)
+    calls = []
+    monkeypatch.setattr(
+        embeddings_module, "embed_texts_np", _recording_embed(calls)
+    )
+
+    table = prepare_flags_module.prepare_flags(lancedb_persistent=True)
+
+    # Only level 2's five documents are re-embedded
+    embedded = [text for batch in calls for text in batch]
+    assert len(embedded) == 5
+    assert all("PASS_CHANGED" in text for text in embedded)
+    assert table.count_rows("level = 3") == 0
+    assert table.count_rows("text LIKE '%PASS_CHANGED%'") == 5
+    rag_levels = [level for level in passwords if level != 5]
+    assert table.count_rows() == 5 * len(rag_levels)
+
+
+def _write_prepared_outputs():
+    os.makedirs(prepare_flags_module.PREPARED_TABLE_DIR, exist_ok=True)
+    open(settings.USERS_DB_PATH, "a").close()
+
+
+def test_prepare_flags_once_runs_once_across_workers(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runs = []
+
+    def slow_prepare(lancedb_persistent=True):
+        runs.append(lancedb_persistent)
+        time.sleep(0.2)
+        _write_prepared_outputs()
+
+    monkeypatch.setattr(prepare_flags_module, "prepare_flags", slow_prepare)
+
+    # Each call opens its own lock file description, like separate workers
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        results = list(
+            pool.map(
+                lambda _: prepare_flags_module.prepare_flags_once(timeout=5),
+                range(4),
+            )
+        )
+
+    assert runs == [True]
+    assert sorted(results) == [False, False, False, True]
+    assert prepare_flags_module.flags_ready()
+
+    # A new deployment version prepares again
+    monkeypatch.setattr(settings, "DEPLOYMENT_VERSION", "next-release")
+    assert not prepare_flags_module.flags_ready()
+    assert prepare_flags_module.prepare_flags_once() is True
+    assert len(runs) == 2
+
+
+def test_prepare_flags_once_reruns_when_outputs_are_missing(
+    tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    runs = []
+
+    def prepare(lancedb_persistent=True):
+        runs.append(1)
+        _write_prepared_outputs()
+
+    monkeypatch.setattr(prepare_flags_module, "prepare_flags", prepare)
+    assert prepare_flags_module.prepare_flags_once() is True
+    assert prepare_flags_module.flags_ready()
+
+    # The marker survived but users.db did not (e.g. a fresh volume mount)
+    os.remove(settings.USERS_DB_PATH)
+    assert not prepare_flags_module.flags_ready()
+    assert prepare_flags_module.prepare_flags_once() is True
+    assert len(runs) == 2
+
+
+def test_deployment_version_includes_embedding_backend(monkeypatch):
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "torch")
+    torch_version = prepare_flags_module.deployment_version()
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "onnx")
+
+    assert prepare_flags_module.deployment_version() != torch_version
+
+
+def test_deployment_version_includes_documents_and_schema(monkeypatch):
+    baseline = prepare_flags_module.deployment_version()
+
+    monkeypatch.setattr(
+        prepare_flags_module,
+        "GENERIC_PASSWORD_TEXT",
+        prepare_flags_module.GENERIC_PASSWORD_TEXT + ["Psst: <placeholder>"],
+    )
+    with_template = prepare_flags_module.deployment_version()
+    assert with_template != baseline
+
+    monkeypatch.setattr(
+        prepare_flags_module,
+        "CTF_LEVELS_SCHEMA",
+        prepare_flags_module.CTF_LEVELS_SCHEMA.append(
+            pa.field("source", pa.string())
+        ),
+    )
+    assert prepare_flags_module.deployment_version() not in (
+        baseline,
+        with_template,
+    )
+
+
+def test_content_hash_does_not_resolve_embedding_backend(monkeypatch):
+    def resolve_backend():
+        raise AssertionError("content_hash resolved the embedding backend")
+
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "onnx")
+    monkeypatch.setattr(
+        embeddings_module, "get_embedding_backend", resolve_backend
+    )
+    monkeypatch.setattr(
+        prepare_flags_module, "resolve_model_revision", lambda: "abc123"
+    )
+    onnx_hash = prepare_flags_module.content_hash("The Password is X", 1)
+    monkeypatch.setattr(settings, "EMBEDDING_BACKEND", "torch")
+
+    assert prepare_flags_module.content_hash("The Password is X", 1) != (
+        onnx_hash
+    )
+
+
+@pytest.mark.integration
+def test_prepare_flags_reconciles_indexes_on_unchanged_data(
+    tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    table = prepare_flags_module.prepare_flags(lancedb_persistent=True)
+    # A run that died after writing rows but before indexing them
+    for index in table.list_indices():
+        table.drop_index(index.name)
+
+    table = prepare_flags_module.prepare_flags(lancedb_persistent=True)
+
+    index_types = {index.index_type for index in table.list_indices()}
+    assert index_types == {"Bitmap", "FTS"}
+    version = table.version
+    assert prepare_flags_module.build_level_indexes(table) == []
+    assert table.version == version
+
+
+def test_prepare_flags_once_proceeds_read_only_on_timeout(
+    tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    runs = []
+    monkeypatch.setattr(
+        prepare_flags_module,
+        "prepare_flags",
+        lambda lancedb_persistent=True: runs.append(1),
+    )
+
+    with open(prepare_flags_module.PREPARE_LOCK_FILE, "a") as held:
+        fcntl.flock(held, fcntl.LOCK_EX)
+        assert prepare_flags_module.prepare_flags_once(timeout=0.2) is False
+
+    assert runs == []
+    assert not prepare_flags_module.flags_ready()
+
+
+def test_importing_prepare_flags_does_not_load_torch():
+    # A no-op boot must not pay for importing torch / transformers
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, ctf.prepare_flags; "
+            "print(sorted({'torch', 'transformers'} & set(sys.modules)))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    assert result.stdout.strip() == "[]"
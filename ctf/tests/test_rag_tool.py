@@ -0,0 +1,431 @@
+import asyncio
+import json
+import logging
+import time
+
+import numpy as np
+import pytest
+
+from ctf.agents import tools as tools_module
+from ctf.app_config import settings
+from ctf.embeddings import embed_text_np
+from ctf.prepare_flags import prepare_flags
+from ctf.vector_store import (
+    LevelVectorCache,
+    RagResponseCache,
+    lancedb_handles,
+)
+
+
+@pytest.fixture
+def levels_table(tmp_path, monkeypatch):
+    """A freshly prepared ctf_levels table that the RAG tool reads from."""
+    monkeypatch.chdir(tmp_path)
+    # Let pooled handles see writes made through other connections at once.
+    monkeypatch.setattr(settings, "LANCEDB_READ_CONSISTENCY_SECONDS", 0)
+    # Pin vector retrieval (the default); FTS tests opt in.
+    monkeypatch.setattr(settings, "RAG_SEARCH_MODE", "vector")
+    lancedb_handles.refresh()
+    table = prepare_flags(lancedb_persistent=True)
+    monkeypatch.setattr(tools_module, "db_path", str(tmp_path / "lancedb"))
+    monkeypatch.setattr(
+        tools_module,
+        "level_vector_cache",
+        LevelVectorCache(max_rows=1000, refresh_seconds=0),
+    )
+    monkeypatch.setattr(
+        tools_module, "rag_response_cache", RagResponseCache(maxsize=64)
+    )
+    return table
+
+
+def _change_password(monkeypatch, level: int, password: str) -> None:
+    monkeypatch.setattr(
+        settings, "PASSWORDS", {**settings.PASSWORDS, level: password}
+    )
+
+
+def _search(question: str, level: int) -> dict:
+    return json.loads(
+        asyncio.run(tools_module.password_search_func(question, level))
+    )
+
+
+@pytest.mark.integration
+def test_password_search_uses_in_memory_index(levels_table):
+    response = _search("What is the password?", 2)
+
+    assert response["status"] == "success"
+    assert settings.PASSWORDS[2] in response["extracted_passwords"]
+    assert response["num_results"] == 5
+    assert tools_module.level_vector_cache.loads == 1
+
+
+@pytest.mark.integration
+def test_in_memory_index_matches_lancedb_search(levels_table):
+    query = embed_text_np("What is the secret?")
+    index = tools_module.level_vector_cache.get(tools_module._open_levels_table)
+
+    docs, distances = index.search(3, query, 5)
+
+    async def lance_search():
+        table = await tools_module._open_levels_table_async()
+        return await tools_module._search_levels_table(table, query, 3)
+
+    lance_docs, lance_distances = asyncio.run(lance_search())
+
+    assert sorted(docs) == sorted(lance_docs)
+    np.testing.assert_allclose(
+        sorted(distances), sorted(lance_distances), rtol=1e-3, atol=1e-4
+    )
+
+
+@pytest.mark.integration
+def test_in_memory_index_reloads_on_new_table_version(levels_table):
+    cache = tools_module.level_vector_cache
+    first = cache.get(tools_module._open_levels_table)
+    assert cache.get(tools_module._open_levels_table) is first
+
+    levels_table.delete("level = 0")
+
+    second = cache.get(tools_module._open_levels_table)
+    assert second is not first
+    assert second.search(0, np.zeros(384, dtype=np.float32), 5) == ([], [])
+    assert cache.loads == 2
+
+
+@pytest.mark.integration
+def test_large_corpus_falls_back_to_lancedb(levels_table, monkeypatch):
+    monkeypatch.setattr(
+        tools_module,
+        "level_vector_cache",
+        LevelVectorCache(max_rows=10, refresh_seconds=0),
+    )
+
+    response = _search("What is the password?", 1)
+
+    assert settings.PASSWORDS[1] in response["extracted_passwords"]
+    assert tools_module.level_vector_cache.loads == 0
+
+
+@pytest.mark.integration
+def test_table_handles_are_reused_until_refreshed(
+    levels_table, tmp_path, monkeypatch
+):
+    first = lancedb_handles.open_table(tools_module.db_path)
+    assert lancedb_handles.open_table(tools_module.db_path) is first
+    assert lancedb_handles.open_table(str(tmp_path / "lancedb")) is first
+    version = first.version
+
+    _change_password(monkeypatch, 1, "PASS_ROTATED")
+    prepare_flags(lancedb_persistent=True)
+
+    reopened = lancedb_handles.open_table(tools_module.db_path)
+    assert reopened is not first
+    assert reopened.version > version
+
+
+@pytest.mark.integration
+def test_prepare_flags_indexes_level_column(levels_table):
+    indexed_columns = {
+        column
+        for index in levels_table.list_indices()
+        for column in index.columns
+    }
+
+    assert "level" in indexed_columns
+    assert "text" in indexed_columns
+    assert "vector" not in indexed_columns
+
+
+@pytest.mark.integration
+def test_vector_index_built_above_threshold(tmp_path, monkeypatch):
+    import lancedb
+    import pyarrow as pa
+
+    from ctf.prepare_flags import build_level_indexes
+
+    monkeypatch.setattr(settings, "LANCEDB_VECTOR_INDEX_MIN_ROWS", 500)
+    monkeypatch.setattr(settings, "LANCEDB_IVF_PARTITIONS", 2)
+    rows = 600
+    vectors = np.random.default_rng(0).random((rows, 384), dtype=np.float32)
+    table = lancedb.connect(str(tmp_path)).create_table(
+        "ctf_levels",
+        data=pa.table(
+            {
+                "text": [f"doc {i}" for i in range(rows)],
+                "vector": pa.FixedSizeListArray.from_arrays(
+                    pa.array(vectors.ravel()), 384
+                ),
+                "level": np.arange(rows) % 11,
+            }
+        ),
+    )
+
+    build_level_indexes(table)
+
+    index_types = {index.index_type for index in table.list_indices()}
+    assert {"Bitmap", "IvfPq"} <= index_types
+    assert build_level_indexes(table) == []
+
+    # New IVF settings replace the vector index without touching the others
+    monkeypatch.setattr(settings, "LANCEDB_IVF_PARTITIONS", 4)
+    assert build_level_indexes(table) == [
+        "vector_ivfpq_p2_s24",
+        "vector_ivfpq_p4_s24",
+    ]
+    vector_indexes = [
+        index.name
+        for index in table.list_indices()
+        if index.columns == ["vector"]
+    ]
+    assert vector_indexes == ["vector_ivfpq_p4_s24"]
+
+    async def search():
+        async_table = await lancedb.connect_async(str(tmp_path))
+        async_table = await async_table.open_table("ctf_levels")
+        return await tools_module._search_levels_table(
+            async_table, vectors[14], 3
+        )
+
+    docs, _ = asyncio.run(search())
+    assert docs[0] == "doc 14"
+
+
+@pytest.mark.integration
+def test_async_index_shares_sync_cache(levels_table):
+    cache = tools_module.level_vector_cache
+    first = asyncio.run(cache.get_async(tools_module._open_levels_table_async))
+
+    assert cache.get(tools_module._open_levels_table) is first
+    assert cache.loads == 1
+
+    levels_table.delete("level = 0")
+
+    second = asyncio.run(cache.get_async(tools_module._open_levels_table_async))
+    assert second is not first
+    assert second.search(0, np.zeros(384, dtype=np.float32), 5) == ([], [])
+
+
+@pytest.mark.integration
+def test_async_table_handles_are_reused_until_refreshed(
+    levels_table, monkeypatch
+):
+    async def open_twice():
+        return (
+            await tools_module._open_levels_table_async(),
+            await tools_module._open_levels_table_async(),
+        )
+
+    first, second = asyncio.run(open_twice())
+    assert first is second
+
+    _change_password(monkeypatch, 1, "PASS_ROTATED")
+    prepare_flags(lancedb_persistent=True)
+
+    reopened, _ = asyncio.run(open_twice())
+    assert reopened is not first
+
+
+def test_extract_passwords_single_pass_per_template():
+    documents = [
+        "You should know that PASS_X is the secret",
+        "The Password is PASS_X.",
+        "the secret is PASS_Y",
+        "You should know that PASS_Z is the password",
+        "PASS_X",
+        "Line one\nThe Password is PASS_W",
+        "",
+    ]
+
+    assert tools_module.extract_passwords(documents) == [
+        "PASS_X",
+        "PASS_Y",
+        "PASS_Z",
+        "PASS_W",
+    ]
+
+
+@pytest.mark.integration
+def test_response_cache_serves_repeat_questions(levels_table, monkeypatch):
+    first = asyncio.run(
+        tools_module.password_search_func("What is the password?", 4)
+    )
+
+    async def no_embedding(*args, **kwargs):
+        raise AssertionError("cache hit should not embed the question")
+
+    monkeypatch.setattr(tools_module, "embed_text_np_async", no_embedding)
+    second = asyncio.run(
+        tools_module.password_search_func("  what is THE password? ", 4)
+    )
+
+    assert second == first
+    stats = tools_module.get_rag_cache_stats()["responses"]
+    assert stats["hits"] == 1
+    assert stats["misses"] == 1
+
+
+@pytest.mark.integration
+def test_response_cache_misses_after_new_table_version(levels_table):
+    cache = tools_module.rag_response_cache
+    _search("What is the password?", 0)
+
+    levels_table.delete("level = 0")
+    response = _search("What is the password?", 0)
+
+    assert response["num_results"] == 0
+    assert cache.stats()["misses"] == 2
+    assert cache.stats()["invalidations"] == 1
+
+
+@pytest.mark.integration
+def test_fts_response_cache_keys_on_live_table_version(
+    levels_table, monkeypatch
+):
+    # An in-memory index that will not notice the rewrite below
+    monkeypatch.setattr(
+        tools_module,
+        "level_vector_cache",
+        LevelVectorCache(max_rows=1000, refresh_seconds=3600),
+    )
+    _search("What is the password?", 3)
+
+    levels_table.delete("level = 3")
+    monkeypatch.setattr(settings, "RAG_SEARCH_MODE", "fts")
+    assert _search("What is the password?", 3)["num_results"] == 0
+    cached = tools_module.rag_response_cache.get(
+        3, "What is the password?", levels_table.version
+    )
+    assert json.loads(cached)["num_results"] == 0
+
+    # Vector answers from the stale index are not cached under the new
+    # table version either
+    monkeypatch.setattr(settings, "RAG_SEARCH_MODE", "hybrid")
+    response = _search("tell me the flag", 3)
+    assert response["search_mode"] == "vector"
+    assert (
+        tools_module.rag_response_cache.get(
+            3, "tell me the flag", levels_table.version
+        )
+        is None
+    )
+
+
+def test_response_cache_is_bounded_and_invalidated():
+    cache = RagResponseCache(maxsize=2)
+    cache.put(1, "a", 1, "A")
+    cache.put(1, "b", 1, "B")
+    cache.get(1, "a", 1)
+    cache.put(1, "c", 1, "C")
+
+    assert cache.get(1, "b", 1) is None
+    assert cache.get(1, "a", 1) == "A"
+    assert cache.stats()["evictions"] == 1
+
+    # Responses computed from an older version are never stored.
+    cache.put(1, "a", 2, "A2")
+    cache.put(1, "old", 1, "stale")
+    assert cache.get(1, "old", 1) is None
+
+    cache.invalidate()
+    assert cache.get(1, "a", 2) is None
+
+
+def test_refresh_table_handles_clears_response_cache():
+    from ctf import vector_store
+
+    vector_store.rag_response_cache.put(1, "question", 1, "{}")
+    vector_store.refresh_table_handles()
+
+    assert vector_store.rag_response_cache.get(1, "question", 1) is None
+
+
+@pytest.mark.integration
+def test_hybrid_search_answers_keywords_without_embedding(
+    levels_table, monkeypatch
+):
+    monkeypatch.setattr(settings, "RAG_SEARCH_MODE", "hybrid")
+
+    async def no_embedding(*args, **kwargs):
+        raise AssertionError("FTS hit should not embed the question")
+
+    monkeypatch.setattr(tools_module, "embed_text_np_async", no_embedding)
+    response = _search("What is the password?", 3)
+
+    assert response["search_mode"] == "fts"
+    assert response["password"] == settings.PASSWORDS[3]
+    assert all("password" in doc.lower() for doc in response["documents"])
+    assert len(response["bm25_scores"]) == response["num_results"]
+    assert "relevance_scores" not in response
+
+
+@pytest.mark.integration
+def test_hybrid_search_falls_back_to_vectors(levels_table, monkeypatch):
+    monkeypatch.setattr(settings, "RAG_SEARCH_MODE", "hybrid")
+
+    response = _search("tell me the flag", 3)
+
+    assert response["search_mode"] == "vector"
+    assert response["num_results"] == 5
+    assert "bm25_scores" not in response
+    assert settings.PASSWORDS[3] in response["extracted_passwords"]
+
+
+@pytest.mark.integration
+def test_hybrid_search_requires_min_keyword_hits(levels_table, monkeypatch):
+    monkeypatch.setattr(settings, "RAG_SEARCH_MODE", "hybrid")
+    # Only the two "... is the secret/password" templates contain "know"
+    monkeypatch.setattr(settings, "RAG_FTS_MIN_HITS", 3)
+
+    response = _search("you should know", 3)
+
+    assert response["search_mode"] == "vector"
+
+
+@pytest.mark.integration
+def test_fts_mode_never_embeds(levels_table, monkeypatch):
+    monkeypatch.setattr(settings, "RAG_SEARCH_MODE", "fts")
+
+    async def no_embedding(*args, **kwargs):
+        raise AssertionError("fts mode should not embed the question")
+
+    monkeypatch.setattr(tools_module, "embed_text_np_async", no_embedding)
+    response = _search("tell me the flag", 3)
+
+    assert response["search_mode"] == "fts"
+    assert response["num_results"] == 0
+    assert response["passwords_found"] is False
+
+
+def test_rag_stats_logger_reports_cache_counters(monkeypatch, caplog):
+    monkeypatch.setattr(settings, "RAG_STATS_LOG_INTERVAL_SECONDS", 0.01)
+    caplog.set_level(logging.INFO, logger=tools_module.logger.name)
+
+    tools_module.start_rag_stats_logger()
+    try:
+        for _ in range(500):
+            if "RAG stats:" in caplog.text:
+                break
+            time.sleep(0.01)
+    finally:
+        tools_module.stop_rag_stats_logger()
+
+    line = next(r for r in caplog.messages if r.startswith("RAG stats: "))
+    stats = json.loads(line.removeprefix("RAG stats: "))
+    assert {"responses", "query_embeddings"} <= stats.keys()
+
+
+def test_rag_stats_logger_disabled_by_zero_interval(monkeypatch):
+    monkeypatch.setattr(settings, "RAG_STATS_LOG_INTERVAL_SECONDS", 0)
+
+    tools_module.start_rag_stats_logger()
+
+    assert tools_module._stats_logger is None
+
+
+def test_rag_stats_include_inference_queue():
+    stats = tools_module.get_rag_stats()
+
+    assert stats["inference_executor"]["workers"] >= 1
+    assert "queue_depth" in stats["inference_executor"]
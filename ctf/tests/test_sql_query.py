@@ -0,0 +1,246 @@
+import asyncio
+import json
+import sqlite3
+import time
+
+import pytest
+
+from ctf.agents.tools import sql_query
+from ctf.app_config import settings
+from ctf.prepare_flags import setup_sql_level
+from ctf.users_db import (
+    SessionDatabases,
+    get_session_databases,
+    get_users_db_pool,
+)
+
+
+@pytest.fixture
+def users_db(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    setup_sql_level("PASS_FIVE")
+    return get_users_db_pool()
+
+
+class _FakeSession:
+    def __init__(self, session_id: str):
+        self.id = session_id
+        self.user_id = "player"
+
+
+class _FakeToolContext:
+    def __init__(self, session_id: str):
+        self.session = _FakeSession(session_id)
+
+
+def test_sql_query_finds_user(users_db):
+    result = asyncio.run(sql_query("2"))
+
+    assert result.startswith("Found user with UserId: 2")
+    assert '"FirstName":"Cryptic"' in result
+
+
+def test_sql_query_injection_returns_every_row(users_db):
+    result = asyncio.run(sql_query("1 OR 1=1"))
+
+    assert "Found 6 user(s)" in result
+    assert "PASS_FIVE" in result
+
+
+def test_sql_query_columns_come_from_cursor_description(users_db):
+    statements = []
+    with users_db.connection() as connection:
+        connection.set_trace_callback(statements.append)
+
+    result = asyncio.run(
+        sql_query("-1 UNION SELECT name, 'x', 'y', 0 FROM sqlite_master")
+    )
+
+    assert '"UserId":"USERS"' in result
+    assert '"TokenCount":0' in result
+    assert not any("PRAGMA" in statement for statement in statements)
+
+
+def test_sql_query_caps_rows_and_reports_the_rest(users_db, monkeypatch):
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_ROWS", 2)
+    monkeypatch.setattr(settings, "SQL_QUERY_FETCH_SIZE", 1)
+
+    result = asyncio.run(sql_query("1 OR 1=1"))
+
+    assert result.startswith("Found 6 user(s)")
+    assert result.count('"UserId"') == 2
+    assert result.endswith("\n... 4 more rows truncated")
+
+
+def test_sql_query_caps_output_bytes(users_db, monkeypatch):
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_BYTES", 200)
+
+    result = asyncio.run(sql_query("1 OR 1=1"))
+    rows_json = result.split("\n")[1]
+
+    assert len(rows_json) <= 200
+    assert json.loads(rows_json)
+    assert result.endswith(
+        f"... {6 - len(json.loads(rows_json))} more rows truncated"
+    )
+
+
+def test_sql_query_reuses_pooled_connections(users_db):
+    for user_id in ["2", "3", "4", "1 OR 1=1"]:
+        asyncio.run(sql_query(user_id))
+
+    assert users_db.opened == 1
+
+
+def test_pooled_connections_are_read_only(users_db):
+    with users_db.connection() as connection:
+        with pytest.raises(sqlite3.OperationalError, match="readonly"):
+            connection.execute("DELETE FROM Users")
+
+
+_RUNAWAY_CTE = (
+    "-1 UNION SELECT * FROM (WITH RECURSIVE n(x) AS "
+    "(SELECT 1 UNION ALL SELECT x + 1 FROM n) "
+    "SELECT x, 'a', 'b', 0 FROM n WHERE x < 0)"
+)
+
+
+def test_sql_query_times_out_runaway_query(users_db, monkeypatch):
+    monkeypatch.setattr(settings, "SQL_QUERY_TIMEOUT_SECONDS", 0.2)
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_VM_STEPS", 0)
+
+    result = asyncio.run(sql_query(_RUNAWAY_CTE))
+
+    assert "ran longer than 0.2s" in result
+    # The interrupted connection goes back to the pool in working order
+    assert "Cryptic" in asyncio.run(sql_query("2"))
+
+
+def test_sql_query_enforces_vm_step_budget(users_db, monkeypatch):
+    monkeypatch.setattr(settings, "SQL_QUERY_TIMEOUT_SECONDS", 30)
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_VM_STEPS", 100_000)
+
+    result = asyncio.run(sql_query(_RUNAWAY_CTE))
+
+    assert "budget of 100000 SQLite steps" in result
+
+
+def test_sql_query_stops_counting_unbounded_results(users_db, monkeypatch):
+    monkeypatch.setattr(settings, "SQL_QUERY_TIMEOUT_SECONDS", 0.2)
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_VM_STEPS", 0)
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_ROWS", 3)
+
+    # UNION ALL streams rows, unlike UNION which dedupes before returning any
+    endless = _RUNAWAY_CTE.replace("-1 UNION", "-1 UNION ALL")
+    result = asyncio.run(sql_query(endless.replace("x < 0", "x > 0")))
+
+    assert "+ user(s)" in result
+    assert "more rows truncated" in result
+    assert "... at least" in result
+
+
+def test_sql_query_bounds_counting_past_the_cap(users_db, monkeypatch):
+    monkeypatch.setattr(settings, "SQL_QUERY_TIMEOUT_SECONDS", 30)
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_VM_STEPS", 0)
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_ROWS", 3)
+    monkeypatch.setattr(settings, "SQL_QUERY_FETCH_SIZE", 100)
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_COUNTED_ROWS", 500)
+
+    endless = _RUNAWAY_CTE.replace("-1 UNION", "-1 UNION ALL")
+    result = asyncio.run(sql_query(endless.replace("x < 0", "x > 0")))
+
+    # Counting stopped at the cap rather than running into the 30s timeout
+    assert "Found 500+ user(s)" in result
+    assert "... at least 497 more rows truncated" in result
+
+
+def test_sql_query_does_not_block_event_loop(users_db, monkeypatch):
+    monkeypatch.setattr(settings, "SQL_QUERY_TIMEOUT_SECONDS", 0.5)
+    monkeypatch.setattr(settings, "SQL_QUERY_MAX_VM_STEPS", 0)
+
+    async def run():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        result = await sql_query(_RUNAWAY_CTE)
+        task.cancel()
+        return result, ticks
+
+    result, ticks = asyncio.run(run())
+
+    assert "ran longer than" in result
+    assert ticks >= 10
+
+
+def test_sessions_query_private_in_memory_copies(users_db):
+    databases = get_session_databases()
+    with databases.connection("alice") as connection:
+        connection.execute("DELETE FROM Users")
+
+    alice = asyncio.run(sql_query("1 OR 1=1", _FakeToolContext("alice")))
+    bob = asyncio.run(sql_query("1 OR 1=1", _FakeToolContext("bob")))
+
+    assert alice.startswith("No users found")
+    assert bob.startswith("Found 6 user(s)")
+    # users.db itself is untouched and never opened through the pool
+    assert asyncio.run(sql_query("1 OR 1=1")).startswith("Found 6 user(s)")
+    assert users_db.opened == 1
+    assert databases.stats()["created"] == 2
+
+
+def test_session_copies_cannot_attach_files(users_db, tmp_path):
+    with get_session_databases().connection("alice") as connection:
+        with pytest.raises(sqlite3.OperationalError):
+            connection.execute("ATTACH DATABASE 'other.db' AS other")
+
+    assert not (tmp_path / "other.db").exists()
+
+
+def test_session_copies_follow_rewritten_users_db(users_db):
+    context = _FakeToolContext("alice")
+    assert "PASS_FIVE" in asyncio.run(sql_query("33", context))
+
+    time.sleep(0.01)
+    setup_sql_level("PASS_FIVE_ROTATED")
+
+    assert "PASS_FIVE_ROTATED" in asyncio.run(sql_query("33", context))
+
+
+def test_session_databases_evict_lru_and_idle_copies(users_db, tmp_path):
+    databases = SessionDatabases(tmp_path / "users.db", 2, ttl_seconds=0.05)
+    for session_id in ["a", "b", "a", "c"]:
+        with databases.connection(session_id):
+            pass
+
+    stats = databases.stats()
+    assert stats["sessions"] == 2
+    assert stats["created"] == 3
+    assert stats["hits"] == 1
+    assert stats["evicted"] == 1  # "b", the least recently used
+
+    time.sleep(0.1)
+    with databases.connection("a"):
+        pass
+    assert databases.stats()["created"] == 4
+    databases.close()
+
+
+def test_session_copy_evicted_mid_query_stays_open(users_db, tmp_path):
+    databases = SessionDatabases(tmp_path / "users.db", 1, ttl_seconds=0)
+    with databases.connection("a") as connection:
+        # "b" pushes "a" out while its query is still running
+        with databases.connection("b"):
+            pass
+        assert databases.stats()["evicted"] == 1
+        assert connection.execute("SELECT COUNT(*) FROM Users").fetchone()
+
+    # The last user to hand the evicted copy back closes it
+    with pytest.raises(sqlite3.ProgrammingError):
+        connection.execute("SELECT 1")
+    databases.close()
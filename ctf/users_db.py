@@ -0,0 +1,463 @@
+"""
+Access to the Level 5 ``users.db`` SQLite database used by the ``sql_query``
+tool. prepare_flags owns writes to the file; the server reads it through a
+pool of read-only connections, or hands each ADK session a private
+in-memory copy.
+"""
+
+from __future__ import annotations
+
+import concurrent.futures
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from urllib.parse import quote
+
+try:
+    from ctf.app_config import settings
+except Exception:
+    from app_config import settings
+
+logger = logging.getLogger(__name__)
+
+
+class QueryLimitExceeded(Exception):
+    """A query was interrupted for running too long or too many VM steps."""
+
+
+class QueryRows:
+    """
+    Capped result of :func:`execute_limited`: the first rows as compact JSON
+    objects plus how many rows the query produced in total. ``exact_total``
+    is False when counting the rows past the cap was itself cut short, in
+    which case ``total_rows`` is a lower bound.
+    """
+
+    def __init__(
+        self,
+        columns: list[str],
+        rows_json: list[str],
+        total_rows: int,
+        exact_total: bool = True,
+    ):
+        self.columns = columns
+        self.rows_json = rows_json
+        self.total_rows = total_rows
+        self.exact_total = exact_total
+
+    @property
+    def truncated_rows(self) -> int:
+        return self.total_rows - len(self.rows_json)
+
+    def to_json(self) -> str:
+        return "[" + ",".join(self.rows_json) + "]"
+
+
+def execute_limited(
+    connection: sqlite3.Connection,
+    query: str,
+    timeout_seconds: float | None = None,
+    max_steps: int | None = None,
+    max_rows: int | None = None,
+    max_bytes: int | None = None,
+    max_counted_rows: int | None = None,
+) -> QueryRows:
+    """
+    Run ``query`` and stream its rows with ``fetchmany``, interrupting it
+    once it runs past ``timeout_seconds`` or executes more than
+    ``max_steps`` SQLite VM instructions (0 disables either limit). Both are
+    enforced from the progress handler, which SQLite calls every
+    SQL_QUERY_PROGRESS_INTERVAL instructions, so a runaway cross join or
+    recursive CTE is stopped mid-statement rather than left to finish.
+
+    Only the first ``max_rows`` rows, up to ``max_bytes`` of compact JSON,
+    are kept; the rest are counted but never materialised. Counting stops
+    once ``max_counted_rows`` rows have been seen, so a huge result does not
+    hold a worker until the timeout just to be counted.
+
+    Raises :class:`QueryLimitExceeded` if a limit trips before the caps
+    were reached.
+    """
+    if timeout_seconds is None:
+        timeout_seconds = settings.SQL_QUERY_TIMEOUT_SECONDS
+    if max_steps is None:
+        max_steps = settings.SQL_QUERY_MAX_VM_STEPS
+    if max_rows is None:
+        max_rows = settings.SQL_QUERY_MAX_ROWS
+    if max_bytes is None:
+        max_bytes = settings.SQL_QUERY_MAX_BYTES
+    if max_counted_rows is None:
+        max_counted_rows = settings.SQL_QUERY_MAX_COUNTED_ROWS
+    interval = max(1, settings.SQL_QUERY_PROGRESS_INTERVAL)
+    deadline = time.monotonic() + timeout_seconds if timeout_seconds else None
+    state = {"steps": 0, "reason": None}
+
+    def progress() -> int:
+        state["steps"] += interval
+        if deadline is not None and time.monotonic() > deadline:
+            state["reason"] = f"the query ran longer than {timeout_seconds:g}s"
+            return 1
+        if max_steps and state["steps"] > max_steps:
+            state["reason"] = (
+                f"the query exceeded the budget of {max_steps} SQLite steps"
+            )
+            return 1
+        return 0
+
+    connection.set_progress_handler(progress, interval)
+    cursor = connection.cursor()
+    result = QueryRows([], [], 0)
+    capped = False
+    size = 2  # enclosing brackets
+    try:
+        cursor.execute(query)
+        result.columns = [col[0] for col in cursor.description or ()]
+        fetch_size = max(1, settings.SQL_QUERY_FETCH_SIZE)
+        while batch := cursor.fetchmany(fetch_size):
+            result.total_rows += len(batch)
+            if capped:
+                if result.total_rows >= max_counted_rows:
+                    result.exact_total = False
+                    break
+                continue
+            for row in batch:
+                if len(result.rows_json) >= max_rows:
+                    capped = True
+                    break
+                encoded = json.dumps(
+                    dict(zip(result.columns, row)),
+                    separators=(",", ":"),
+                    default=str,
+                )
+                # ensure_ascii keeps len() equal to the encoded byte count
+                if size + len(encoded) + 1 > max_bytes:
+                    capped = True
+                    break
+                result.rows_json.append(encoded)
+                size += len(encoded) + 1
+        return result
+    except sqlite3.OperationalError:
+        if state["reason"] is None:
+            raise
+        if capped:
+            # Interrupted while only counting rows past the cap
+            result.exact_total = False
+            return result
+        raise QueryLimitExceeded(
+            f"Query cancelled because {state['reason']}. "
+            "Try a more specific query."
+        ) from None
+    finally:
+        cursor.close()
+        connection.set_progress_handler(None, 0)
+
+
+_query_executor: concurrent.futures.ThreadPoolExecutor | None = None
+_query_executor_lock = threading.Lock()
+
+
+def get_query_executor() -> concurrent.futures.ThreadPoolExecutor:
+    """
+    Dedicated threads for player-supplied SQL, so slow Level 5 queries
+    neither block the event loop nor exhaust the loop's default executor.
+    """
+    global _query_executor
+    if _query_executor is None:
+        with _query_executor_lock:
+            if _query_executor is None:
+                _query_executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=max(1, settings.SQL_QUERY_WORKERS),
+                    thread_name_prefix="sql-query",
+                )
+    return _query_executor
+
+
+class ReadOnlyConnectionPool:
+    """
+    Per-process pool of read-only SQLite connections to one database file.
+
+    Connections are opened with a ``mode=ro`` URI (plus ``immutable=1`` when
+    USERS_DB_IMMUTABLE is set, which skips file locking entirely but must
+    only be used when nothing rewrites the file while the server runs) and
+    handed back to the pool after each query. They are not bound to the
+    opening thread, so a query may run on any worker thread. A pool
+    inherited across ``fork`` is discarded rather than shared.
+    """
+
+    def __init__(self, db_file: str | Path, max_size: int):
+        self.db_file = Path(db_file)
+        self.max_size = max(1, max_size)
+        self._idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self._pid = os.getpid()
+        self.opened = 0
+
+    def _uri(self) -> str:
+        uri = f"file:{quote(str(self.db_file))}?mode=ro"
+        if settings.USERS_DB_IMMUTABLE:
+            uri += "&immutable=1"
+        return uri
+
+    def _open(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(
+            self._uri(), uri=True, check_same_thread=False
+        )
+        self.opened += 1
+        return connection
+
+    def acquire(self) -> sqlite3.Connection:
+        if os.getpid() != self._pid:
+            # Forked child: never touch the parent's connections
+            self._idle = queue.LifoQueue()
+            self._pid = os.getpid()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._open()
+
+    def release(self, connection: sqlite3.Connection) -> None:
+        if self._idle.qsize() >= self.max_size or os.getpid() != self._pid:
+            connection.close()
+        else:
+            self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a ``with`` block."""
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+_pools: dict[str, ReadOnlyConnectionPool] = {}
+_pools_lock = threading.Lock()
+
+
+def get_users_db_pool() -> ReadOnlyConnectionPool:
+    """The pool for USERS_DB_PATH, resolved against the current directory."""
+    key = str(Path(settings.USERS_DB_PATH).resolve())
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(
+                key,
+                ReadOnlyConnectionPool(key, settings.USERS_DB_POOL_SIZE),
+            )
+    return pool
+
+
+class _SessionCopy:
+    """
+    One session's in-memory copy. ``users`` counts the ``with`` blocks that
+    have it checked out, and ``retired`` marks a copy that was evicted
+    while still in use; the last user to hand it back closes it.
+    """
+
+    __slots__ = ("connection", "lock", "last_used", "mtime", "users", "retired")
+
+    def __init__(self, connection: sqlite3.Connection, mtime: int, now: float):
+        self.connection = connection
+        self.lock = threading.Lock()
+        self.last_used = now
+        self.mtime = mtime
+        self.users = 0
+        self.retired = False
+
+
+class SessionDatabases:
+    """
+    Private in-memory copies of a database, one per session.
+
+    The file is read once into an in-memory template (again only when its
+    mtime changes), and each session's copy is cloned from that template
+    with the SQLite backup API, so queries read nothing from disk (beyond a
+    stat of the file's mtime) and players never contend on one file lock.
+    Whatever an injection changes stays in that player's copy. ``ATTACH`` is
+    disabled on the copies so they cannot reach the filesystem either.
+
+    Copies are evicted least recently used first once ``max_sessions`` is
+    exceeded, and dropped after ``ttl_seconds`` without a query. A copy
+    evicted while a query has it checked out is closed only once that query
+    hands it back.
+    """
+
+    def __init__(
+        self, db_file: str | Path, max_sessions: int, ttl_seconds: float
+    ):
+        self.db_file = Path(db_file)
+        self.max_sessions = max(1, max_sessions)
+        self.ttl_seconds = ttl_seconds
+        self._sessions: OrderedDict[str, _SessionCopy] = OrderedDict()
+        self._lock = threading.Lock()
+        self._template: sqlite3.Connection | None = None
+        self._template_mtime: int | None = None
+        self._template_lock = threading.Lock()
+        self.hits = 0
+        self.created = 0
+        self.evicted = 0
+
+    def _clone(self) -> tuple[sqlite3.Connection, int]:
+        """
+        Copy the in-memory template into a new connection, reloading the
+        template from disk first if the file has changed.
+        """
+        connection = sqlite3.connect(":memory:", check_same_thread=False)
+        connection.setlimit(sqlite3.SQLITE_LIMIT_ATTACHED, 0)
+        mtime = self.db_file.stat().st_mtime_ns
+        with self._template_lock:
+            if self._template is None or mtime != self._template_mtime:
+                source = sqlite3.connect(
+                    f"file:{quote(str(self.db_file))}?mode=ro", uri=True
+                )
+                template = sqlite3.connect(":memory:", check_same_thread=False)
+                try:
+                    source.backup(template)
+                finally:
+                    source.close()
+                if self._template is not None:
+                    self._template.close()
+                self._template, self._template_mtime = template, mtime
+            self._template.backup(connection)
+            self.created += 1
+            return connection, self._template_mtime
+
+    @staticmethod
+    def _retire(copies: list[_SessionCopy]) -> list[_SessionCopy]:
+        """
+        Mark copies already removed from ``_sessions`` as retired and return
+        those nobody has checked out, which are safe to close. The caller
+        holds ``_lock``.
+        """
+        for copy in copies:
+            copy.retired = True
+        return [copy for copy in copies if copy.users == 0]
+
+    def _expire(self, now: float) -> list[_SessionCopy]:
+        """Pop idle and surplus sessions; the caller holds ``_lock``."""
+        dropped = []
+        for session_id, copy in list(self._sessions.items()):
+            if len(self._sessions) > self.max_sessions or (
+                self.ttl_seconds and now - copy.last_used > self.ttl_seconds
+            ):
+                dropped.append(self._sessions.pop(session_id))
+            else:
+                # Oldest first, so every later entry is fresher
+                break
+        self.evicted += len(dropped)
+        return dropped
+
+    @staticmethod
+    def _close(copies: list[_SessionCopy]) -> None:
+        for copy in copies:
+            copy.connection.close()
+
+    def _checkout(self, session_id: str) -> _SessionCopy:
+        now = time.monotonic()
+        mtime = self.db_file.stat().st_mtime_ns
+        with self._lock:
+            copy = self._sessions.pop(session_id, None)
+            stale = []
+            if copy is not None and (
+                copy.mtime != mtime
+                or (
+                    self.ttl_seconds and now - copy.last_used > self.ttl_seconds
+                )
+            ):
+                # users.db was rewritten (new password) or the copy idled out
+                stale = self._retire([copy])
+                copy = None
+                self.evicted += 1
+            if copy is not None:
+                self.hits += 1
+                copy.last_used = now
+                copy.users += 1
+                self._sessions[session_id] = copy
+        self._close(stale)
+        if copy is not None:
+            return copy
+
+        connection, template_mtime = self._clone()
+        copy = _SessionCopy(connection, template_mtime, now)
+        copy.users = 1
+        with self._lock:
+            previous = self._sessions.pop(session_id, None)
+            self._sessions[session_id] = copy
+            dropped = [previous] if previous is not None else []
+            stale = self._retire(dropped + self._expire(now))
+        self._close(stale)
+        return copy
+
+    def _checkin(self, copy: _SessionCopy) -> None:
+        with self._lock:
+            copy.users -= 1
+            closing = copy.retired and copy.users == 0
+        if closing:
+            copy.connection.close()
+
+    @contextmanager
+    def connection(self, session_id: str):
+        """
+        Borrow ``session_id``'s copy for a ``with`` block. Queries from one
+        session are serialised on it; different sessions run in parallel.
+        """
+        copy = self._checkout(session_id)
+        try:
+            with copy.lock:
+                yield copy.connection
+        finally:
+            self._checkin(copy)
+
+    def close(self) -> None:
+        with self._lock:
+            copies = self._retire(list(self._sessions.values()))
+            self._sessions.clear()
+        self._close(copies)
+        with self._template_lock:
+            if self._template is not None:
+                self._template.close()
+                self._template = None
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.created
+        return {
+            "sessions": len(self._sessions),
+            "hits": self.hits,
+            "created": self.created,
+            "evicted": self.evicted,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+
+_session_databases: dict[str, SessionDatabases] = {}
+
+
+def get_session_databases() -> SessionDatabases:
+    """The per-session copies of USERS_DB_PATH in this process."""
+    key = str(Path(settings.USERS_DB_PATH).resolve())
+    databases = _session_databases.get(key)
+    if databases is None:
+        with _pools_lock:
+            databases = _session_databases.setdefault(
+                key,
+                SessionDatabases(
+                    key,
+                    settings.USERS_DB_SESSION_MAX,
+                    settings.USERS_DB_SESSION_TTL_SECONDS,
+                ),
+            )
+    return databases
@@ -0,0 +1,429 @@
+"""
+In-process retrieval helpers for the LanceDB ``ctf_levels`` table used by the
+RAG tool, shared with prepare_flags.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import timedelta
+from pathlib import Path
+from typing import Callable
+
+import lancedb
+import numpy as np
+
+try:
+    from ctf.app_config import settings
+    from ctf.embeddings import normalize_query_text
+except Exception:
+    from app_config import settings
+    from embeddings import normalize_query_text
+
+logger = logging.getLogger(__name__)
+
+TABLE_NAME = "ctf_levels"
+INDEX_COLUMNS = ["text", "vector", "level"]
+
+
+class LanceDBHandles:
+    """
+    Process-wide cache of LanceDB connections and opened tables.
+
+    Connections and table handles are opened lazily, once per database
+    path, and reused for every later call. Sync handles serve writers such
+    as prepare_flags; the RAG tool uses the ``*_async`` handles so searches
+    never block the event loop. Connections are created with
+    ``read_consistency_interval`` so cached handles still pick up versions
+    written by other processes; writers in this process call
+    :func:`refresh_table_handles` to drop handles immediately.
+    """
+
+    def __init__(self):
+        self._connections: dict[str, lancedb.DBConnection] = {}
+        self._tables: dict[tuple[str, str], object] = {}
+        self._async_connections: dict[str, lancedb.AsyncConnection] = {}
+        self._async_tables: dict[tuple[str, str], object] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(db_path: str) -> str:
+        return str(Path(db_path).resolve())
+
+    @staticmethod
+    def _read_consistency_interval() -> timedelta | None:
+        interval = settings.LANCEDB_READ_CONSISTENCY_SECONDS
+        return timedelta(seconds=interval) if interval >= 0 else None
+
+    def connect(self, db_path: str) -> lancedb.DBConnection:
+        key = self._key(db_path)
+        connection = self._connections.get(key)
+        if connection is not None:
+            return connection
+        with self._lock:
+            connection = self._connections.get(key)
+            if connection is None:
+                connection = lancedb.connect(
+                    key,
+                    read_consistency_interval=self._read_consistency_interval(),
+                )
+                self._connections[key] = connection
+            return connection
+
+    def open_table(self, db_path: str, table_name: str = TABLE_NAME):
+        key = (self._key(db_path), table_name)
+        table = self._tables.get(key)
+        if table is not None:
+            return table
+        connection = self.connect(db_path)
+        with self._lock:
+            table = self._tables.get(key)
+            if table is None:
+                table = connection.open_table(table_name)
+                self._tables[key] = table
+            return table
+
+    async def connect_async(self, db_path: str) -> lancedb.AsyncConnection:
+        key = self._key(db_path)
+        connection = self._async_connections.get(key)
+        if connection is None:
+            # A concurrent first call may connect twice; last one wins and
+            # both handles stay valid, so no lock is held across the await.
+            connection = await lancedb.connect_async(
+                key, read_consistency_interval=self._read_consistency_interval()
+            )
+            self._async_connections[key] = connection
+        return connection
+
+    async def open_table_async(
+        self, db_path: str, table_name: str = TABLE_NAME
+    ):
+        key = (self._key(db_path), table_name)
+        table = self._async_tables.get(key)
+        if table is None:
+            connection = await self.connect_async(db_path)
+            table = await connection.open_table(table_name)
+            self._async_tables[key] = table
+        return table
+
+    def refresh(
+        self, db_path: str | None = None, table_name: str | None = None
+    ) -> None:
+        """Drop cached handles (all, or those for ``db_path``/``table_name``)."""
+        path_key = self._key(db_path) if db_path is not None else None
+        with self._lock:
+            for tables in (self._tables, self._async_tables):
+                for key in list(tables):
+                    if (path_key is None or key[0] == path_key) and (
+                        table_name is None or key[1] == table_name
+                    ):
+                        del tables[key]
+            if table_name is None:
+                for connections in (
+                    self._connections,
+                    self._async_connections,
+                ):
+                    for key in list(connections):
+                        if path_key is None or key == path_key:
+                            del connections[key]
+
+
+lancedb_handles = LanceDBHandles()
+
+
+class LevelVectorIndex:
+    """
+    Contiguous per-level vector matrices for one version of ``ctf_levels``.
+
+    Search computes squared L2 distances (LanceDB's default metric) for the
+    whole level with a single matrix-vector product, so the returned
+    distances line up with what a LanceDB vector search reports.
+    """
+
+    def __init__(
+        self,
+        version: int,
+        levels: dict[int, tuple[list[str], np.ndarray, np.ndarray]],
+    ):
+        self.version = version
+        self._levels = levels
+
+    @classmethod
+    def from_table(cls, table) -> LevelVectorIndex:
+        data = table.search().select(INDEX_COLUMNS).limit(None).to_arrow()
+        return cls.from_arrow(table.version, data)
+
+    @classmethod
+    async def from_table_async(cls, table) -> LevelVectorIndex:
+        version = await table.version()
+        data = await table.query().select(INDEX_COLUMNS).to_arrow()
+        return cls.from_arrow(version, data)
+
+    @classmethod
+    def from_arrow(cls, version: int, data) -> LevelVectorIndex:
+        texts = data.column("text").to_pylist()
+        level_ids = data.column("level").to_numpy()
+        vector_column = data.column("vector").combine_chunks()
+        dim = vector_column.type.list_size
+        vectors = (
+            vector_column.values.to_numpy(zero_copy_only=False)
+            .astype(np.float32, copy=False)
+            .reshape(-1, dim)
+        )
+
+        levels = {}
+        for level in np.unique(level_ids):
+            rows = np.flatnonzero(level_ids == level)
+            matrix = np.ascontiguousarray(vectors[rows])
+            sq_norms = np.einsum("ij,ij->i", matrix, matrix)
+            levels[int(level)] = ([texts[i] for i in rows], matrix, sq_norms)
+        return cls(version, levels)
+
+    @property
+    def num_rows(self) -> int:
+        return sum(len(texts) for texts, _, _ in self._levels.values())
+
+    @property
+    def nbytes(self) -> int:
+        """Bytes held by the vector matrices and their norms."""
+        return sum(
+            matrix.nbytes + sq_norms.nbytes
+            for _, matrix, sq_norms in self._levels.values()
+        )
+
+    def search(
+        self, level: int, query_vector, limit: int
+    ) -> tuple[list[str], list[float]]:
+        """Return the ``limit`` nearest texts for ``level`` and their distances."""
+        entry = self._levels.get(int(level))
+        if entry is None or limit <= 0:
+            return [], []
+
+        texts, matrix, sq_norms = entry
+        query = np.asarray(query_vector, dtype=np.float32)
+        distances = sq_norms - 2.0 * (matrix @ query) + query @ query
+        np.maximum(distances, 0.0, out=distances)
+
+        k = min(limit, len(texts))
+        if k < len(texts):
+            top = np.argpartition(distances, k - 1)[:k]
+            top = top[np.argsort(distances[top], kind="stable")]
+        else:
+            top = np.argsort(distances, kind="stable")
+        return [texts[i] for i in top], distances[top].tolist()
+
+
+class LevelVectorCache:
+    """
+    Keeps a :class:`LevelVectorIndex` for the current ``ctf_levels`` version.
+
+    The LanceDB table is only consulted every ``refresh_seconds`` to compare
+    versions; the index is rebuilt when the version changes. Tables with
+    more than ``max_rows`` rows are not loaded, and ``get`` returns None so
+    the caller falls back to a LanceDB search.
+    """
+
+    def __init__(self, max_rows: int, refresh_seconds: float):
+        self.max_rows = max_rows
+        self.refresh_seconds = refresh_seconds
+        self._index: LevelVectorIndex | None = None
+        self._version: int | None = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        # asyncio locks are bound to a loop, so keep one per running loop
+        self._async_locks = weakref.WeakKeyDictionary()
+        self.loads = 0
+
+    def _fresh(self) -> bool:
+        return (
+            self._version is not None
+            and time.monotonic() - self._checked_at < self.refresh_seconds
+        )
+
+    def get(self, open_table: Callable) -> LevelVectorIndex | None:
+        """Return the in-memory index, or None if the corpus is too large."""
+        if self._fresh():
+            return self._index
+
+        with self._lock:
+            if self._fresh():
+                return self._index
+
+            table = open_table()
+            version = table.version
+            if version != self._version:
+                self._index = self._load(table)
+                self._version = version
+            self._checked_at = time.monotonic()
+            return self._index
+
+    async def get_async(self, open_table) -> LevelVectorIndex | None:
+        """Async ``get``: ``open_table`` is a coroutine function returning
+        a LanceDB AsyncTable, and no disk I/O blocks the event loop."""
+        if self._fresh():
+            return self._index
+
+        loop = asyncio.get_running_loop()
+        lock = self._async_locks.get(loop)
+        if lock is None:
+            lock = self._async_locks[loop] = asyncio.Lock()
+
+        async with lock:
+            if self._fresh():
+                return self._index
+
+            table = await open_table()
+            version = await table.version()
+            if version != self._version:
+                index = None
+                if self._within_row_limit(await table.count_rows()):
+                    started = time.perf_counter()
+                    index = await LevelVectorIndex.from_table_async(table)
+                    self._loaded(index, started)
+                self._index = index
+                self._version = version
+            self._checked_at = time.monotonic()
+            return self._index
+
+    def _within_row_limit(self, rows: int) -> bool:
+        if rows > self.max_rows:
+            logger.info(
+                f"{TABLE_NAME} has {rows} rows (> {self.max_rows}); "
+                "using LanceDB search instead of the in-memory index"
+            )
+            return False
+        return True
+
+    def _load(self, table) -> LevelVectorIndex | None:
+        if not self._within_row_limit(table.count_rows()):
+            return None
+
+        started = time.perf_counter()
+        index = LevelVectorIndex.from_table(table)
+        self._loaded(index, started)
+        return index
+
+    def _loaded(self, index: LevelVectorIndex, started: float) -> None:
+        self.loads += 1
+        logger.info(
+            f"Loaded {index.num_rows} {TABLE_NAME} vectors (version "
+            f"{index.version}) in {(time.perf_counter() - started) * 1000:.1f}ms"
+        )
+
+    def invalidate(self) -> None:
+        """Force the next ``get`` to re-check the table version."""
+        with self._lock:
+            self._index = None
+            self._version = None
+            self._checked_at = 0.0
+
+
+level_vector_cache = LevelVectorCache(
+    max_rows=settings.VECTOR_CACHE_MAX_ROWS,
+    refresh_seconds=settings.VECTOR_CACHE_REFRESH_SECONDS,
+)
+
+
+class RagResponseCache:
+    """
+    Bounded LRU cache of serialized RAG tool responses.
+
+    A response is fully determined by the level, the question and the
+    ``ctf_levels`` version it was computed from, so entries are keyed on
+    ``(level, normalized question, version)``. Seeing a newer version drops
+    every entry for older ones, and :func:`refresh_table_handles` clears the
+    cache outright when prepare_flags rewrites the table.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = max(0, maxsize)
+        self._entries: OrderedDict[tuple, str] = OrderedDict()
+        self._latest_version: int | None = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _key(level, question: str, version: int) -> tuple:
+        return (str(level), normalize_query_text(question), version)
+
+    def get(self, level, question: str, version: int) -> str | None:
+        """Return the cached response, or None on a miss."""
+        key = self._key(level, question, version)
+        with self._lock:
+            response = self._entries.get(key)
+            if response is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return response
+
+    def put(self, level, question: str, version: int, response: str) -> None:
+        """Store ``response``, evicting the least recently used entries."""
+        if not self.maxsize:
+            return
+        key = self._key(level, question, version)
+        with self._lock:
+            if self._latest_version is None or version > self._latest_version:
+                stale = [k for k in self._entries if k[2] != version]
+                for stale_key in stale:
+                    del self._entries[stale_key]
+                self.invalidations += len(stale)
+                self._latest_version = version
+            elif version < self._latest_version:
+                # Computed from a table version that has since been replaced.
+                return
+            self._entries[key] = response
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self) -> None:
+        """Drop every entry, e.g. after the table was rewritten."""
+        with self._lock:
+            self.invalidations += len(self._entries)
+            self._entries.clear()
+            self._latest_version = None
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters for this cache."""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+                "table_version": self._latest_version,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+            }
+
+
+rag_response_cache = RagResponseCache(maxsize=settings.RAG_RESPONSE_CACHE_SIZE)
+
+
+def refresh_table_handles(
+    db_path: str | None = None, table_name: str = TABLE_NAME
+) -> None:
+    """
+    Hook for writers: forget cached handles, in-memory vectors and RAG
+    responses for a table.
+
+    Called by prepare_flags after it rewrites ``ctf_levels`` so the next RAG
+    query in this process reopens the table instead of serving stale data.
+    """
+    lancedb_handles.refresh(db_path, table_name)
+    if table_name == TABLE_NAME:
+        level_vector_cache.invalidate()
+        rag_response_cache.invalidate()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark: materialising RAG search results with to_pandas() versus
+Arrow with column projection. Both variants run the same async LanceDB
+query that password_search_func's LanceDB path does, so the difference is
+only the result conversion.
+
+Uses random vectors, so no embedding model is needed.
+
+Usage:
+    uv run scripts/bench_rag_results.py
+    uv run scripts/bench_rag_results.py --rows-per-level 500 --queries 500
+"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import lancedb
+import numpy as np
+import pyarrow as pa
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from ctf.agents.tools import (  # noqa: E402
+    RAG_RESULT_COLUMNS,
+    _documents_from_arrow,
+)
+
+DIM = 384
+LEVELS = 11
+
+
+def build_table(db_path: str, rows_per_level: int):
+    rng = np.random.default_rng(0)
+    rows = rows_per_level * LEVELS
+    vectors = rng.standard_normal((rows, DIM), dtype=np.float32)
+    data = pa.table(
+        {
+            "id": [f"doc-{i}" for i in range(rows)],
+            "text": [f"The Password is PASS_{i}" for i in range(rows)],
+            "vector": pa.FixedSizeListArray.from_arrays(
+                pa.array(vectors.ravel()), DIM
+            ),
+            "level": np.repeat(np.arange(LEVELS), rows_per_level),
+        }
+    )
+    return lancedb.connect(db_path).create_table("ctf_levels", data=data)
+
+
+def level_query(table, query, level):
+    return table.vector_search(query).where(f"level = {level}").limit(5)
+
+
+async def pandas_path(table, query, level):
+    results = await level_query(table, query, level).to_pandas()
+    return results["text"].tolist(), results["_distance"].tolist()
+
+
+async def arrow_path(table, query, level):
+    results = await (
+        level_query(table, query, level).select(RAG_RESULT_COLUMNS).to_arrow()
+    )
+    return _documents_from_arrow(results)
+
+
+async def time_path(fn, table, queries) -> list[float]:
+    timings = []
+    for i, query in enumerate(queries):
+        started = time.perf_counter()
+        await fn(table, query, i % LEVELS)
+        timings.append((time.perf_counter() - started) * 1e6)
+    return timings
+
+
+async def run(db_path: str, queries) -> dict[str, list[float]]:
+    db = await lancedb.connect_async(db_path)
+    table = await db.open_table("ctf_levels")
+    results = {}
+    for name, fn in (
+        ("to_pandas", pandas_path),
+        ("arrow + projection", arrow_path),
+    ):
+        # Warm up (lazy imports, file cache)
+        await time_path(fn, table, queries[:20])
+        results[name] = await time_path(fn, table, queries)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows-per-level", type=int, default=5)
+    parser.add_argument("--queries", type=int, default=300)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="lancedb_bench_") as db_path:
+        build_table(db_path, args.rows_per_level)
+        rng = np.random.default_rng(1)
+        queries = rng.standard_normal((args.queries, DIM), dtype=np.float32)
+        results = asyncio.run(run(db_path, queries))
+
+    print(f"{args.queries} queries, {args.rows_per_level} rows/level")
+    for name, timings in results.items():
+        print(
+            f"{name:>20}: mean {statistics.mean(timings):8.1f}us  "
+            f"p50 {statistics.median(timings):8.1f}us"
+        )
+    saving = statistics.mean(results["to_pandas"]) - statistics.mean(
+        results["arrow + projection"]
+    )
+    print(f"{'saving per query':>20}: {saving:8.1f}us")
+
+
+if __name__ == "__main__":
+    main()
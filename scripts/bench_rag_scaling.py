@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+Benchmark RAG retrieval over a large corpus built by
+scripts/generate_decoy_corpus.py, for each retrieval configuration:
+
+    in-memory  per-level NumPy matrices (LevelVectorIndex); exact, used as
+               the brute-force ground truth
+    flat       LanceDB vector search with the vector index bypassed
+    indexed    LanceDB IVF-PQ search as password_search_func runs it
+               (RAG_NPROBES / RAG_REFINE_FACTOR)
+
+Reports p50/p95/p99 latency, recall@k against brute force and resident
+memory. Queries are stored vectors plus a little Gaussian noise, so their
+neighbours are meaningful for model and random vectors alike.
+
+Usage:
+    uv run scripts/generate_decoy_corpus.py --docs-per-level 50000 --vectors random
+    uv run scripts/bench_rag_scaling.py
+    uv run scripts/bench_rag_scaling.py --table ctf_levels_decoys --queries 500
+"""
+
+import argparse
+import asyncio
+import resource
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import lancedb
+import numpy as np
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from ctf.agents.tools import RAG_RESULT_COLUMNS  # noqa: E402
+from ctf.agents.tools import _search_levels_table  # noqa: E402
+from ctf.vector_store import LevelVectorIndex  # noqa: E402
+
+DEFAULT_TABLE = "ctf_levels_decoys"
+
+
+def rss_mb() -> float:
+    """Current resident set size, falling back to the peak off Linux."""
+    try:
+        with open("/proc/self/statm") as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize() / 2**20
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def percentiles(timings_ms: list[float]) -> tuple[float, float, float]:
+    cuts = statistics.quantiles(timings_ms, n=100, method="inclusive")
+    return cuts[49], cuts[94], cuts[98]
+
+
+def sample_queries(table, levels, count: int, noise: float, rng):
+    """Pick stored vectors per level and perturb them."""
+    per_level = -(-count // len(levels))
+    queries = []
+    for level in levels:
+        rows = (
+            table.search()
+            .where(f"level = {level}", prefilter=True)
+            .select(["vector"])
+            .limit(per_level * 20)
+            .to_arrow()
+        )
+        vectors = np.stack(rows.column("vector").to_numpy(zero_copy_only=False))
+        picks = rng.choice(len(vectors), size=min(per_level, len(vectors)))
+        for vector in vectors[picks].astype(np.float32):
+            jitter = rng.standard_normal(vector.shape, dtype=np.float32)
+            scale = noise * np.linalg.norm(vector) / np.sqrt(len(vector))
+            queries.append((int(level), vector + scale * jitter))
+    rng.shuffle(queries)
+    return queries[:count]
+
+
+def recall(distances: list[float], exact: list[float]) -> float:
+    """Share of results within the exact k-th neighbour distance (ties ok)."""
+    if not exact:
+        return 1.0
+    bound = exact[-1] * (1 + 1e-4) + 1e-6
+    return sum(d <= bound for d in distances) / len(exact)
+
+
+async def flat_search(table, query_vector, level: int):
+    results = await (
+        table.vector_search(query_vector)
+        .where(f"level = {level}")
+        .select(RAG_RESULT_COLUMNS)
+        .limit(5)
+        .bypass_vector_index()
+        .to_arrow()
+    )
+    return (
+        results.column("text").to_pylist(),
+        results.column("_distance").to_pylist(),
+    )
+
+
+async def time_lancedb(search, table, queries, truth):
+    timings, recalls = [], []
+    for (level, query), exact in zip(queries, truth):
+        started = time.perf_counter()
+        _, distances = await search(table, query, level)
+        timings.append((time.perf_counter() - started) * 1000)
+        recalls.append(recall(distances, exact))
+    return timings, recalls
+
+
+async def bench_lancedb(db_path, table_name, queries, truth, indexed: bool):
+    db = await lancedb.connect_async(db_path)
+    table = await db.open_table(table_name)
+    results = {}
+    configs = [("flat", flat_search)]
+    if indexed:
+        configs.append(("indexed", _search_levels_table))
+    for name, search in configs:
+        # Warm-up: lazy imports, file and index caches
+        await time_lancedb(search, table, queries[:10], truth[:10])
+        before = rss_mb()
+        timings, recalls = await time_lancedb(search, table, queries, truth)
+        results[name] = (timings, recalls, rss_mb() - before)
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--db-path", default="./lancedb")
+    parser.add_argument("--table", default=DEFAULT_TABLE)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--noise", type=float, default=0.05)
+    args = parser.parse_args()
+
+    table = lancedb.connect(args.db_path).open_table(args.table)
+    rows = table.count_rows()
+    index_types = {index.index_type for index in table.list_indices()}
+    indexed = any(kind.startswith("Ivf") for kind in index_types)
+    levels = sorted(
+        set(
+            table.search()
+            .select(["level"])
+            .limit(None)
+            .to_arrow()
+            .column("level")
+            .to_pylist()
+        )
+    )
+    queries = sample_queries(
+        table, levels, args.queries, args.noise, np.random.default_rng(0)
+    )
+
+    before = rss_mb()
+    started = time.perf_counter()
+    index = LevelVectorIndex.from_table(table)
+    load_s = time.perf_counter() - started
+    in_memory_mb = rss_mb() - before
+
+    timings, truth = [], []
+    for level, query in queries:
+        started = time.perf_counter()
+        _, distances = index.search(level, query, 5)
+        timings.append((time.perf_counter() - started) * 1000)
+        truth.append(distances)
+    results = {"in-memory": (timings, [1.0] * len(truth), in_memory_mb)}
+    results.update(
+        asyncio.run(
+            bench_lancedb(args.db_path, args.table, queries, truth, indexed)
+        )
+    )
+
+    print(
+        f"{args.table}: {rows} rows, {len(levels)} levels, "
+        f"{len(queries)} queries, indexes: {sorted(index_types) or 'none'}"
+    )
+    print(
+        f"in-memory index loaded in {load_s:.2f}s, "
+        f"{index.nbytes / 2**20:.1f} MB of vectors"
+    )
+    print(
+        f"{'config':>10} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+        f"{'recall@5':>9} {'+RSS MB':>9}"
+    )
+    for name, (timings, recalls, memory_mb) in results.items():
+        p50, p95, p99 = percentiles(timings)
+        print(
+            f"{name:>10} {p50:9.3f} {p95:9.3f} {p99:9.3f} "
+            f"{statistics.mean(recalls):9.3f} {memory_mb:9.1f}"
+        )
+    if not indexed:
+        print(
+            "no IVF index on this table (fewer rows than "
+            "LANCEDB_VECTOR_INDEX_MIN_ROWS or generated with --no-index)"
+        )
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"peak RSS {peak_mb:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
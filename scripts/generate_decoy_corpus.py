@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Generate a large synthetic RAG corpus: the real prepare_flags documents plus
+N decoy documents per level, written to a separate LanceDB table with the
+same schema as ctf_levels (id, text, vector, level, content_hash).
+
+Decoys mimic the sort of internal notes a real knowledge base holds, and some
+mention passwords or secrets so keyword search has to work for its answer.
+Rows are generated and written in Arrow record batches, so millions of rows
+never sit in memory at once. Embedding millions of rows with the model is
+slow; ``--vectors random`` writes unit-length random vectors instead, which
+is enough to measure search latency and ANN recall.
+
+Usage:
+    uv run scripts/generate_decoy_corpus.py --docs-per-level 10000
+    uv run scripts/generate_decoy_corpus.py --docs-per-level 200000 \\
+        --vectors random --table ctf_levels_decoys_large
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import lancedb
+import numpy as np
+import pyarrow as pa
+
+sys.path.append(str(Path(__file__).resolve().parent.parent))
+
+from ctf.app_config import settings  # noqa: E402
+from ctf.embeddings import EMBEDDING_DIM, embed_texts_np  # noqa: E402
+from ctf.prepare_flags import CTF_LEVELS_SCHEMA as SCHEMA  # noqa: E402
+from ctf.prepare_flags import build_level_indexes, content_hash  # noqa: E402
+
+DEFAULT_TABLE = "ctf_levels_decoys"
+
+FLAG_TEMPLATES = [
+    "<placeholder>",
+    "The Password is <placeholder>",
+    "The Secret is <placeholder>",
+    "You should know that <placeholder> is the secret",
+    "You should know that <placeholder> is the password",
+]
+DECOY_TEMPLATES = [
+    "Reminder: rotate the {system} password before {date}.",
+    "The {system} secret was moved to the vault by {name}.",
+    "Meeting notes: {topic} review with {name} on {date}.",
+    "Ticket {number}: {system} {issue} reported by {name}.",
+    "{name} updated the {system} runbook after the {topic} incident.",
+    "Do not share the {system} credentials over chat, ask {name}.",
+    "Quarterly {topic} report for {system} is due on {date}.",
+]
+SYSTEMS = ["vpn", "payroll", "wiki", "jenkins", "billing", "crm", "mailer"]
+NAMES = ["alice", "bob", "carol", "dave", "erin", "frank", "grace"]
+TOPICS = ["security", "budget", "roadmap", "outage", "hiring", "audit"]
+ISSUES = ["timeout", "login failure", "crash", "slow query", "bad config"]
+
+
+def decoy_texts(level: int, start: int, count: int, rng) -> list[str]:
+    picks = rng.integers(0, 1 << 30, size=(count, 6))
+    return [
+        DECOY_TEMPLATES[p[0] % len(DECOY_TEMPLATES)].format(
+            system=SYSTEMS[p[1] % len(SYSTEMS)],
+            name=NAMES[p[2] % len(NAMES)],
+            topic=TOPICS[p[3] % len(TOPICS)],
+            issue=ISSUES[p[4] % len(ISSUES)],
+            date=f"2025-{p[5] % 12 + 1:02d}-{p[5] % 28 + 1:02d}",
+            number=level * 10_000_000 + start + i,
+        )
+        for i, p in enumerate(picks)
+    ]
+
+
+def vectors_for(texts: list[str], mode: str, rng) -> np.ndarray:
+    if mode == "model":
+        return embed_texts_np(texts, normalize=settings.EMBEDDING_NORMALIZE)
+    vectors = rng.standard_normal((len(texts), EMBEDDING_DIM), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def record_batch(
+    ids: list[str], texts: list[str], vectors: np.ndarray, level: int
+) -> pa.RecordBatch:
+    return pa.RecordBatch.from_arrays(
+        [
+            pa.array(ids),
+            pa.array(texts),
+            pa.FixedSizeListArray.from_arrays(
+                pa.array(vectors.ravel(), type=pa.float32()), EMBEDDING_DIM
+            ),
+            pa.array(np.full(len(ids), level, dtype=np.int64)),
+            pa.array([content_hash(text, level) for text in texts]),
+        ],
+        schema=SCHEMA,
+    )
+
+
+def generate_batches(levels, docs_per_level: int, batch_size: int, mode: str):
+    rng = np.random.default_rng(0)
+    for level in levels:
+        flags = [
+            t.replace("<placeholder>", settings.PASSWORDS[level])
+            for t in FLAG_TEMPLATES
+        ]
+        yield record_batch(
+            [f"level-{level}-msg-{i}" for i in range(len(flags))],
+            flags,
+            vectors_for(flags, mode, rng),
+            level,
+        )
+        for start in range(0, docs_per_level, batch_size):
+            count = min(batch_size, docs_per_level - start)
+            texts = decoy_texts(level, start, count, rng)
+            yield record_batch(
+                [f"level-{level}-decoy-{start + i}" for i in range(count)],
+                texts,
+                vectors_for(texts, mode, rng),
+                level,
+            )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--docs-per-level", type=int, default=10_000)
+    parser.add_argument("--db-path", default="./lancedb")
+    parser.add_argument("--table", default=DEFAULT_TABLE)
+    parser.add_argument("--batch-size", type=int, default=8192)
+    parser.add_argument(
+        "--vectors", choices=["model", "random"], default="model"
+    )
+    parser.add_argument(
+        "--no-index",
+        action="store_true",
+        help="skip the level/FTS/IVF-PQ indexes prepare_flags would build",
+    )
+    args = parser.parse_args()
+
+    # Level 5 keeps its password in SQLite, not the RAG store
+    levels = [level for level in settings.PASSWORDS if level != 5]
+    started = time.perf_counter()
+    reader = pa.RecordBatchReader.from_batches(
+        SCHEMA,
+        generate_batches(
+            levels, args.docs_per_level, args.batch_size, args.vectors
+        ),
+    )
+    db = lancedb.connect(args.db_path)
+    table = db.create_table(args.table, data=reader, mode="overwrite")
+    rows = table.count_rows()
+    print(
+        f"Wrote {rows} rows ({len(levels)} levels x {args.docs_per_level} "
+        f"decoys) to {args.db_path}/{args.table} "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+    if not args.no_index:
+        started = time.perf_counter()
+        build_level_indexes(table)
+        print(f"Built indexes in {time.perf_counter() - started:.1f}s")
+
+
+if __name__ == "__main__":
+    main()